@@ -0,0 +1,49 @@
+"""
+Modules as they stood at an earlier git revision, for the benches to
+measure the current code against. They're read straight out of git, so
+the reference is always the real old code rather than a checked-in copy.
+Needs the git history, i.e. a clone rather than a release tarball.
+"""
+
+import os
+import re
+import subprocess
+import sys
+import types
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the last str media playlist rewriters, before PlaylistRewriter replaced them
+LEGACY_REVISION = "018715a"
+# the last str PlaylistRewriter, before it took upstream bytes
+STR_REVISION = "59a035d"
+
+def source(revision:str, path:str) -> str:
+    result = subprocess.run(["git", "-C", REPO, "show", f"{revision}:{path}"], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"can't read {path} at {revision} from git: {result.stderr.strip()}")
+    return result.stdout
+
+def load(revision:str, *modules:str) -> list:
+    """modules (dotted names, e.g. baseball_pipe.playlist.timeline) as of revision.
+
+    Each one is loaded under its own name with the revision on the end, so
+    it sits alongside the current one. Modules in the same call import each
+    other's old copies, so list them dependencies first. Anything else they
+    import comes from the working tree.
+    """
+    names = {module: f"{module.rpartition('.')[2]}_{revision}" for module in modules}
+
+    loaded = []
+    for module in modules:
+        path = "src/" + module.replace(".", "/") + ".py"
+        code = source(revision, path)
+        for old, new in names.items():
+            code = re.sub(rf"\b{re.escape(old)}\b", new, code)
+
+        loaded_module = types.ModuleType(names[module])
+        loaded_module.__file__ = f"{revision}:{path}"
+        sys.modules[names[module]] = loaded_module
+        exec(compile(code, loaded_module.__file__, "exec"), loaded_module.__dict__)
+        loaded.append(loaded_module)
+    return loaded
@@ -0,0 +1,130 @@
+"""
+Time and peak allocation of the bytes rewrite path (upstream bytes in,
+response bytes out) against the str path it replaced (the rewriter as of
+baseline.STR_REVISION, read from git: decode, rewrite as str, encode for
+web.Response) on one long upstream media playlist.
+
+    PYTHONPATH=src python bench/bench_bytes.py [--segments N] [--repeat N]
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import baseline
+from bench_rewrite import build_playlist, OWN_BASE, FIRST_SEGMENT, SEGMENT_DURATION, RESOLUTION, FRAME_RATE, FILLER_SEGMENT
+from baseball_pipe.playlist import stream_mangler as sm
+from baseball_pipe.playlist.timeline import SegmentTimeline
+from baseball_pipe.playlist.ad_breaks import AdBreakMap
+
+_, _, str_mangler = baseline.load(baseline.STR_REVISION,
+                                  "baseball_pipe.playlist.timeline",
+                                  "baseball_pipe.playlist.ad_breaks",
+                                  "baseball_pipe.playlist.stream_mangler")
+
+def pipeline(module, timeline_cls, ad_map_cls, start_time, end_time, decode):
+    """Everything one media playlist request does between upstream body and response body."""
+    def run(body):
+        media = body.decode() if decode else body
+        timeline = timeline_cls()
+        timeline.update(media)
+        ad_breaks = ad_map_cls()
+        ad_breaks.update(media, timeline)
+        rewriter = module.PlaylistRewriter(OWN_BASE,
+                                           policy=sm.FILLER,
+                                           start_time=start_time,
+                                           end_time=end_time,
+                                           resolution=RESOLUTION,
+                                           frame_rate=FRAME_RATE,
+                                           filler_duration=FILLER_SEGMENT,
+                                           ad_breaks=ad_breaks)
+        out = rewriter.feed(media, timeline=timeline)
+        return out.encode() if decode else out
+    return run
+
+def reserve(module, timeline_cls, ad_map_cls, start_time, end_time, decode, body):
+    """A poll that finds nothing new upstream: just hand the same playlist back."""
+    media = body.decode() if decode else body
+    timeline = timeline_cls()
+    timeline.update(media)
+    ad_breaks = ad_map_cls()
+    ad_breaks.update(media, timeline)
+    rewriter = module.PlaylistRewriter(OWN_BASE,
+                                       policy=sm.FILLER,
+                                       start_time=start_time,
+                                       end_time=end_time,
+                                       resolution=RESOLUTION,
+                                       frame_rate=FRAME_RATE,
+                                       filler_duration=FILLER_SEGMENT,
+                                       ad_breaks=ad_breaks)
+    rewriter.feed(media, timeline=timeline)
+
+    def run(body):
+        out = rewriter.feed(media, timeline=timeline)
+        return out.encode() if decode else out
+    return run
+
+def best_time(fn, body, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn(body)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, out
+
+def peak_allocation(fn, body):
+    fn(body) # warm caches (filler blocks, PROGRAM-DATE-TIME minutes) first
+    tracemalloc.start()
+    out = fn(body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del out
+    return peak
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--segments", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=7)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+
+    body = build_playlist(args.segments, breaks=40).encode()
+    n_lines = body.count(b"\n")
+    start_time = FIRST_SEGMENT + timedelta(minutes=5)
+    end_time = FIRST_SEGMENT + timedelta(seconds=(args.segments - 20) * SEGMENT_DURATION)
+
+    cases = [
+        ("str path (decode, rewrite, encode)", pipeline(str_mangler, str_mangler.SegmentTimeline, str_mangler.AdBreakMap, start_time, end_time, decode=True)),
+        ("bytes path", pipeline(sm, SegmentTimeline, AdBreakMap, start_time, end_time, decode=False)),
+    ]
+
+    print(f"{args.segments} segments, {n_lines} upstream lines, {len(body) / 1024:.0f}KB, best of {args.repeat}")
+    results = []
+    for name, fn in cases:
+        elapsed, out = best_time(fn, body, args.repeat)
+        peak = peak_allocation(fn, body)
+        results.append(out)
+        print(f"{name:36} {elapsed * 1000:8.2f}ms  {elapsed / n_lines * 1e9:6.0f}ns/line  peak {peak / 1024:8.0f}KB")
+
+    # the str snapshot predates EXT-X-SERVER-CONTROL
+    bytes_out = b"\n".join(line for line in results[1].split(b"\n") if not line.startswith(b"#EXT-X-SERVER-CONTROL"))
+    print(f"output identical: {results[0] == bytes_out}")
+
+    for name, fn in [
+        ("str path, unchanged playlist", reserve(str_mangler, str_mangler.SegmentTimeline, str_mangler.AdBreakMap, start_time, end_time, True, body)),
+        ("bytes path, unchanged playlist", reserve(sm, SegmentTimeline, AdBreakMap, start_time, end_time, False, body)),
+    ]:
+        elapsed, out = best_time(fn, body, args.repeat)
+        peak = peak_allocation(fn, body)
+        print(f"{name:36} {elapsed * 1000:8.3f}ms  peak {peak / 1024:8.0f}KB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Per-line throughput of stream_mangler.PlaylistRewriter against the rewriters
+it replaced (stream_mangler as of baseline.LEGACY_REVISION, read from git),
+on a synthetic 9-inning upstream playlist.
+
+    PYTHONPATH=src python bench/bench_rewrite.py [--segments N] [--repeat N] [--pregame MIN]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import re
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import baseline
+from baseball_pipe.mlbtv.media_playlist import SPLIT_RES, NTSC_FPS, FILLER_DURATION
+from baseball_pipe.playlist import stream_mangler as sm
+from baseball_pipe.playlist.timeline import SegmentTimeline
+from baseball_pipe.playlist.ad_breaks import AdBreakMap
+
+OWN_BASE = "/824567/a85458be-cd51-49c5-94b9-80bc7c0a71e4/"
+FIRST_SEGMENT = datetime(2026, 7, 4, 23, 0, tzinfo=timezone.utc)
+SEGMENT_DURATION = 6.006
+RESOLUTION = (1920, 1080)
+FRAME_RATE = "30000/1001"
+FILLER_SEGMENT = 1.001
+# the last ad segment of a break comes up short, so breaks aren't a whole
+# number of filler segments long and the filler has to round
+LAST_AD_SEGMENT = 4.5
+
+legacy_mangler, = baseline.load(baseline.LEGACY_REVISION, "baseball_pipe.playlist.stream_mangler")
+
+FILLER_CUE_OUT_PATTERN = re.compile(r"#EXT-X-CUE-OUT:[\d.]+(?=\n#EXT-X-DISCONTINUITY)")
+FILLER_LABEL_PATTERN = re.compile(r"filler_\d{3}(?=\.ts)")
+
+def build_playlist(segments:int=1900, breaks:int=17, break_segments:int=20, playlist_type:str="VOD") -> str:
+    """A full game's upstream media playlist: pregame, 17 half-inning ad breaks, postgame."""
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        "#EXT-X-TARGETDURATION:7",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        f"#EXT-X-PLAYLIST-TYPE:{playlist_type}",
+        '#EXT-X-KEY:METHOD=AES-128,URI="keys/0001.key",IV=0x00000000000000000000000000000001',
+    ]
+    spacing = segments // (breaks + 1)
+    ad_duration = (break_segments - 1) * SEGMENT_DURATION + LAST_AD_SEGMENT
+    stream_time = FIRST_SEGMENT
+    remaining = 0
+
+    for i in range(segments):
+        if i and i % spacing == 0 and i // spacing <= breaks:
+            lines.append(f"#EXT-X-CUE-OUT:{ad_duration:.3f}")
+            lines.append('#EXT-OATCLS-SCTE35:/DAlAAAAAAAAAP/wFAUAAAABf+/+AAAAAH4AUmXAAAEAAAAAAA==')
+            remaining = break_segments
+
+        ms = stream_time.microsecond // 1000
+        lines.append(f"#EXT-X-PROGRAM-DATE-TIME:{stream_time:%Y-%m-%dT%H:%M:%S}.{ms:03d}Z")
+        if remaining and remaining != break_segments:
+            elapsed = (break_segments - remaining) * SEGMENT_DURATION
+            lines.append(f"#EXT-X-CUE-OUT-CONT:ElapsedTime={elapsed:.3f},Duration={ad_duration:.3f}")
+        duration = LAST_AD_SEGMENT if remaining == 1 else SEGMENT_DURATION
+        lines.append(f"#EXTINF:{duration:.3f},")
+        lines.append(f"1080p/{i:05d}.ts")
+        stream_time += timedelta(seconds=duration)
+
+        if remaining:
+            remaining -= 1
+            if not remaining:
+                lines.append("#EXT-X-CUE-IN")
+
+    if playlist_type == "VOD":
+        lines.append("#EXT-X-ENDLIST")
+
+    return "\n".join(lines) + "\n"
+
+class FakePlaylist():
+    """Just enough of mlbtv.media_playlist.Playlist for the legacy rewriters."""
+
+    def __init__(self):
+        self.mdict = {SPLIT_RES: RESOLUTION, NTSC_FPS: FRAME_RATE, FILLER_DURATION: FILLER_SEGMENT}
+        self.rewrite_states = {}
+
+    def __str__(self):
+        return "bench/1080p.m3u8"
+
+    def set_segments(self, segments, positions=None):
+        pass
+
+class FakeStream():
+    """Just enough of mlbtv.stream.Stream for the legacy rewriters."""
+
+    def __init__(self, start_time, end_time):
+        self.start_time = start_time
+        self.end_time = end_time
+
+    async def get_start(self):
+        return self.start_time
+
+    async def get_end(self):
+        return self.end_time
+
+def index(media):
+    timeline = SegmentTimeline()
+    timeline.update(media)
+    return timeline
+
+def ad_map(media, timeline):
+    ad_breaks = AdBreakMap()
+    ad_breaks.update(media, timeline)
+    return ad_breaks
+
+def engine(policy, start_time, end_time, timeline=None, ad_breaks=None):
+    # the timeline is built once per upstream version and shared by every
+    # rewriter of that variant, so it's timed on its own below
+    def run(media):
+        rewriter = sm.PlaylistRewriter(OWN_BASE,
+                                       policy=policy,
+                                       start_time=start_time,
+                                       end_time=end_time,
+                                       resolution=RESOLUTION,
+                                       frame_rate=FRAME_RATE,
+                                       filler_duration=FILLER_SEGMENT,
+                                       ad_breaks=ad_breaks)
+        return rewriter.feed(media, timeline=timeline)
+    return run
+
+def legacy(start_time, end_time):
+    stream = FakeStream(start_time, end_time)
+
+    def live2(media):
+        return asyncio.run(legacy_mangler.rewrite_live_playlist2(stream, FakePlaylist(), media, OWN_BASE,
+                                                                 start_time=start_time, end_time=end_time))
+
+    def vod3(media):
+        return asyncio.run(legacy_mangler.rewrite_vod_playlist3(stream, "bench", media.split('\n'), OWN_BASE,
+                                                                start_time=start_time, end_time=end_time))
+
+    def nuke(media):
+        return asyncio.run(legacy_mangler.nuke_playlist_ads(stream, "bench", media.split('\n'), OWN_BASE))
+
+    return live2, vod3, nuke
+
+def measure(fn, media, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn(media)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, out
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--segments", type=int, default=1900)
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--pregame", type=float, default=5, help="minutes trimmed off the front")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+
+    media = build_playlist(args.segments)
+    n_lines = media.count("\n")
+    # trim the same way a real game does: a little pregame off the front,
+    # a little postgame off the back
+    start_time = FIRST_SEGMENT + timedelta(minutes=args.pregame)
+    end_time = FIRST_SEGMENT + timedelta(seconds=(args.segments - 20) * SEGMENT_DURATION)
+
+    # the legacy rewriters took str, PlaylistRewriter takes the upstream bytes
+    data = media.encode()
+    live2, vod3, nuke = legacy(start_time, end_time)
+    timeline = index(data)
+    # likewise the ad-break map, built by whichever variant gets there first
+    ad_breaks = ad_map(data, timeline)
+    cases = [
+        ("legacy rewrite_live_playlist2", live2, media),
+        ("legacy rewrite_vod_playlist3", vod3, media),
+        ("legacy nuke_playlist_ads", nuke, media),
+        ("SegmentTimeline build", index, data),
+        ("AdBreakMap build", lambda data: ad_map(data, timeline), data),
+        ("PlaylistRewriter filler", engine(sm.FILLER, start_time, end_time, timeline), data),
+        ("PlaylistRewriter filler, ad map", engine(sm.FILLER, start_time, end_time, timeline, ad_breaks), data),
+        ("PlaylistRewriter filler, no index", engine(sm.FILLER, start_time, end_time), data),
+        ("PlaylistRewriter strip", engine(sm.STRIP, start_time, end_time, timeline), data),
+        ("PlaylistRewriter strip, ad map", engine(sm.STRIP, start_time, end_time, timeline, ad_breaks), data),
+        ("PlaylistRewriter passthrough", engine(sm.PASSTHROUGH, start_time, end_time, timeline), data),
+    ]
+
+    print(f"{n_lines} upstream lines, {len(media) / 1024:.0f}KB, best of {args.repeat}")
+    results = {}
+    for name, fn, source in cases:
+        elapsed, out = measure(fn, source, args.repeat)
+        results[name] = out.decode() if isinstance(out, bytes) else out
+        print(f"{name:36} {elapsed * 1000:8.2f}ms  {n_lines / elapsed / 1e6:6.2f}M lines/s  {elapsed / n_lines * 1e9:7.0f}ns/line")
+
+    # the legacy rewriter predates blocking reload, so it never adds SERVER-CONTROL
+    def without_server_control(text):
+        return "\n".join(line for line in text.split("\n") if not line.startswith("#EXT-X-SERVER-CONTROL"))
+
+    # filler breaks now run their CUE-OUT duration and countdown from the
+    # filler's own length (a whole number of segments) rather than the raw
+    # ad duration, so those two can differ by design -- everything else can't
+    def without_filler_lengths(text):
+        text = FILLER_CUE_OUT_PATTERN.sub("#EXT-X-CUE-OUT:", text)
+        return FILLER_LABEL_PATTERN.sub("filler_", text)
+
+    legacy_out = results["legacy rewrite_live_playlist2"]
+    for name in ("PlaylistRewriter filler", "PlaylistRewriter filler, no index", "PlaylistRewriter filler, ad map"):
+        out = without_server_control(results[name])
+        same = legacy_out == out
+        close = without_filler_lengths(legacy_out) == without_filler_lengths(out)
+        print(f"{name} output identical to rewrite_live_playlist2: {same}, apart from filler lengths: {close}")
+    same = results["PlaylistRewriter strip"] == results["PlaylistRewriter strip, ad map"]
+    print(f"PlaylistRewriter strip, ad map output identical to strip: {same}")
+
+if __name__ == "__main__":
+    main()
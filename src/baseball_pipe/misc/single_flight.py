@@ -0,0 +1,55 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class SingleFlight():
+    """Coalesce concurrent calls for the same key into one in-flight call.
+
+    The first caller for a key starts the work as its own task; everyone who
+    asks for that key before it finishes awaits the same task and gets the
+    same result or the same exception. Waiters are shielded from the task, so
+    a player disconnecting mid-request only cancels its own wait, never the
+    shared fetch the other players are still waiting on.
+    """
+
+    def __init__(self):
+        self._calls = {} # key -> asyncio.Future
+
+    def __len__(self):
+        return len(self._calls)
+
+    def in_flight(self, key) -> bool:
+        return key in self._calls
+
+    def _forget(self, key, future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+        # mark the exception as retrieved so a failed call nobody else joined
+        # doesn't trip asyncio's "exception was never retrieved" warning
+        if not future.cancelled():
+            future.exception()
+
+    def track(self, key, future):
+        """Register a future the caller drives itself (e.g. a streamed relay) so do() calls join it."""
+        if key in self._calls:
+            raise KeyError(f"{key} is already in flight")
+
+        self._calls[key] = future
+        future.add_done_callback(lambda f: self._forget(key, f))
+        return future
+
+    async def do(self, key, fn):
+        """Await fn() for key, joining an existing call if one is in flight.
+
+        fn is a zero-argument callable returning a coroutine, so the coroutine
+        is only ever created by the caller that actually ends up running it.
+        """
+        future = self._calls.get(key)
+        if future is None:
+            future = self.track(key, asyncio.ensure_future(fn()))
+        else:
+            logger.debug(f"joining in-flight call for {key}")
+
+        return await asyncio.shield(future)
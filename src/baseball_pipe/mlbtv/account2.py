@@ -1,7 +1,10 @@
+import asyncio
 import base64
 import hashlib
 import logging
 import os
+import time
+from collections import OrderedDict
 
 import aiohttp
 from curl_cffi.requests import AsyncSession
@@ -9,7 +12,13 @@ from curl_cffi.requests import AsyncSession
 import baseball_pipe.misc.utilities as u
 import baseball_pipe.misc.header_handler as e
 import baseball_pipe.mlbtv.stream
+from baseball_pipe.misc.single_flight import SingleFlight
 from baseball_pipe.mlbtv.token import Token
+from baseball_pipe.mlbtv.segment_cache import SegmentCache
+from baseball_pipe.mlbtv.prefetcher import Prefetcher
+from baseball_pipe.mlbtv.viewer_registry import ViewerRegistry
+from baseball_pipe.mlbtv.session_renewer import SessionRenewer, RENEW_SESSIONS
+from baseball_pipe.playlist.playlist_poller import PlaylistPoller, POLL_PLAYLISTS
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +31,19 @@ TOKEN_URL = "https://ids.mlb.com/oauth2/aus1m088yK07noBfh356/v1/token"
 # and the HTTP headers claim the same Chrome version
 IMPERSONATE = "chrome142"
 
+# streams kept around for reuse -- a stream nobody's watching is dropped
+# once it's been idle this long, or to make room past the count
+MAX_STREAMS = int(os.environ.get("bbp_max_streams", 16))
+STREAM_IDLE_TIMEOUT = float(os.environ.get("bbp_stream_idle", 1800))
+# don't walk every stream on every request looking for idle ones
+STREAM_SWEEP_INTERVAL = 30.0
+
+# log in again in the background this many seconds before the token
+# expires (or halfway there, for a shorter-lived token), and wait this
+# long between attempts if that fails
+TOKEN_REFRESH_BEFORE = float(os.environ.get("bbp_token_refresh_before", 600))
+TOKEN_RETRY = 60.0
+
 class Account():
 
     def __init__(self,
@@ -37,12 +59,39 @@ class Account():
         self.auth_session = auth_session
         self.proxy = proxy
 
+        # outlives reset() on purpose -- segments are keyed by game/media id,
+        # so a replacement Stream for the same broadcast keeps its warm cache
+        self.segment_cache = SegmentCache()
+        self.prefetcher = Prefetcher()
+        self.poller = PlaylistPoller() if POLL_PLAYLISTS else None
+
+        # only spend upstream fetches and cache memory on what's being watched
+        self.viewers = ViewerRegistry()
+        self.viewers.subscribe(on_leave=self.prefetcher.on_viewer_leave)
+        self.viewers.subscribe(on_leave=self.segment_cache.on_viewer_leave)
+        if self.poller is not None:
+            self.viewers.subscribe(on_leave=self.poller.on_viewer_leave)
+        self.renewer = SessionRenewer(self.viewers) if RENEW_SESSIONS else None
+
+        # concurrent requests for an expired stream share one replacement
+        self._stream_flights = SingleFlight()
+        self._last_sweep = time.monotonic()
+
+        # streams and the token outlive reset() too -- a stream just picks up
+        # the new token, see refresh_token()
+        self._streams = OrderedDict() # id -> Stream, least recently used first
+        self._stream_used = {}        # id -> monotonic time of the last get_stream()
+        self._token = None
+
+        # one login at a time, the handshake state below is shared
+        self._token_lock = asyncio.Lock()
+        self._token_task = None
+
         self.reset()
 
         logger.info(f"mlbtv account initialized for {self.u} with proxy {self.proxy}")
 
     def reset(self):
-        self._streams = {}
         self._interaction_handle = None
         self._introspect_state_handle = None
         self._code_verifier = None
@@ -53,7 +102,24 @@ class Account():
         self._challenge_state_handle = None
         self._answer_state_handle =  None
         self._interaction_code = None
-        self._token = None
+
+    async def start(self):
+        """Log in, then keep the token fresh in the background."""
+        await self.refresh_token()
+        self._token_task = asyncio.ensure_future(self._keep_token_fresh())
+
+    async def close(self):
+        tasks = [self._token_task] if self._token_task else []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        await self.viewers.close()
+        if self.renewer is not None:
+            await self.renewer.close()
+        await self.prefetcher.close()
+        if self.poller is not None:
+            await self.poller.close()
 
     async def test(self): # test account's ability to create a stream
         stream:baseball_pipe.mlbtv.stream.Stream = await self.get_stream("823440", "a85458be-cd51-49c5-94b9-80bc7c0a71e4")
@@ -66,22 +132,114 @@ class Account():
     async def get_stream(self, game_pk:str, media_id:str):
         id = f"{game_pk}/{media_id}"
 
-        if not self._token or self._token.is_expired():
-            self.reset()
-            await self._gen_token()
+        await self.get_token()
 
-        if id not in self._streams.keys() or self._streams[id].is_expired():
-            self._streams[id] = baseball_pipe.mlbtv.stream.Stream(self._token, game_pk, media_id, self.session, self.proxy)
-            await self._streams[id].get_master_playlist_url()
+        stream = self._streams.get(id)
+        if stream is None or stream.is_expired():
+            stream = await self._stream_flights.do(id, lambda: self._gen_stream(game_pk, media_id))
 
-        return self._streams[id]
+        if id in self._streams:
+            self._streams.move_to_end(id)
+            self._stream_used[id] = time.monotonic()
+        self._evict_streams(keep=id)
+
+        if self.renewer is not None:
+            self.renewer.watch(stream)
+        return stream
+
+    async def _gen_stream(self, game_pk:str, media_id:str):
+        id = f"{game_pk}/{media_id}"
+
+        # replaced while we were waiting our turn
+        stream = self._streams.get(id)
+        if stream is not None and not stream.is_expired():
+            return stream
+
+        stream = baseball_pipe.mlbtv.stream.Stream(self._token, game_pk, media_id, self.session, self.proxy, segment_cache=self.segment_cache, prefetcher=self.prefetcher, poller=self.poller, viewers=self.viewers)
+        await stream.get_master_playlist_url()
+
+        self._streams[id] = stream
+        self._stream_used[id] = time.monotonic()
+        return stream
+
+    def _evict_streams(self, keep:str=None):
+        """Drop streams nobody's watching: the least recently used past MAX_STREAMS, and any idle too long."""
+        now = time.monotonic()
+        if len(self._streams) <= MAX_STREAMS and now - self._last_sweep < STREAM_SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+
+        for id in list(self._streams):
+            if id == keep or self.viewers.count(id):
+                continue
+            idle = now - self._stream_used.get(id, 0.0)
+            if idle > STREAM_IDLE_TIMEOUT:
+                self._drop_stream(id, f"idle for {idle:.0f}s")
+            elif len(self._streams) > MAX_STREAMS:
+                self._drop_stream(id, f"over {MAX_STREAMS} streams")
+
+    def _drop_stream(self, id:str, reason:str):
+        stream = self._streams.pop(id)
+        self._stream_used.pop(id, None)
+        if self.poller is not None:
+            self.poller.forget(id)
+        self.prefetcher.forget(id)
+        if self.renewer is not None:
+            self.renewer.forget(id)
+        logger.info(f"dropped stream {id} ({reason}), freeing about {stream.nbytes() // 1024}KB of playlists")
+
+    def stats(self) -> dict:
+        return {
+            "streams": len(self._streams),
+            "viewers": len(self.viewers),
+            "playlist_bytes": sum(stream.nbytes() for stream in self._streams.values()),
+        }
 
     async def get_token(self) -> Token:
+        # normally the background refresh got here first
         if not self._token or self._token.is_expired():
+            await self.refresh_token()
+        return self._token
+
+    async def refresh_token(self, force:bool=False) -> Token:
+        """Run the login handshake for a new token, once however many callers ask at the same time.
+
+        Unless forced, a token that hasn't expired is kept. Every stream
+        is handed the new token, so their sessions and caches carry on.
+        """
+        previous = self._token
+        async with self._token_lock:
+            # whoever held the lock before us already got one
+            if self._token is not previous:
+                return self._token
+            if not force and self._token and not self._token.is_expired():
+                return self._token
+
             self.reset()
             await self._gen_token()
+
+            for stream in self._streams.values():
+                stream.token = self._token
+            logger.info(f"new token, expires in {self._token.secs_until_expired()} seconds")
         return self._token
 
+    async def _keep_token_fresh(self):
+        failures = 0
+        while True:
+            if failures:
+                wait = TOKEN_RETRY
+            else:
+                remaining = self._token.secs_until_expired()
+                wait = remaining - min(TOKEN_REFRESH_BEFORE, remaining / 2)
+            await asyncio.sleep(max(1.0, wait))
+
+            try:
+                await self.refresh_token(force=True)
+                failures = 0
+            except Exception as err:
+                failures += 1
+                logger.warning(f"background token refresh failed ({failures} in a row): {err}")
+
     async def _post_interact(self):
 
         def gen_challenge(code_verifier):
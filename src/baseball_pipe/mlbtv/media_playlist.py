@@ -1,7 +1,12 @@
+import asyncio
 import logging
+import time
 from typing import TYPE_CHECKING
 
 from baseball_pipe.misc import header_handler as e
+from baseball_pipe.mlbtv.playlist_cache import CachedPlaylist, target_duration, DEFAULT_TTL
+from baseball_pipe.playlist.timeline import SegmentTimeline
+from baseball_pipe.playlist.segment_list import SegmentList
 from baseball_pipe.playlist import generate_filler_segments as gfs
 
 if TYPE_CHECKING:
@@ -36,6 +41,12 @@ VIDEO = "VIDEO"
 
 logger = logging.getLogger(__name__)
 
+# the shortest a blocked reload waits before looking at the playlist again
+MIN_MEDIA_WAIT = 0.5
+# a polled copy this many target durations old means the poller's backing
+# off from upstream errors -- players go check upstream themselves again
+MAX_POLLED_AGE = 3
+
 class Playlist():
 
     def __init__(self, stream: "Stream", name: str, media_dict:dict):
@@ -43,6 +54,21 @@ class Playlist():
         self.name = name
         self.mdict = media_dict
         self.media = None
+        self._media_cache = CachedPlaylist()
+        # resolved (and replaced) whenever upstream sends something new, see wait_for_media()
+        self._media_changed = None
+        # set while a PlaylistPoller is keeping _media_cache up to date for us
+        self.polled = False
+
+        # real (non-ad) segments from the last rewrite, in playback order
+        self.segments = SegmentList()
+
+        # where each upstream segment sits in time, see get_timeline()
+        self.timeline = SegmentTimeline()
+
+        # stream_mangler.PlaylistRewriter per own_base, so refreshes only rewrite what's new
+        self.rewriters = {}
+        self.rewrite_lock = asyncio.Lock()
 
         if RESOLUTION in media_dict and FRAME_RATE in media_dict:
             try:
@@ -62,16 +88,104 @@ class Playlist():
     def __repr__(self):
         return f"{self.parent_stream}/{self.name}"
 
+    def nbytes(self) -> int:
+        """Roughly what this variant costs in memory: upstream copy, timeline and rewrites."""
+        media = len(self.media or b"")
+        if self._media_cache.text is not self.media:
+            media += len(self._media_cache.text or b"")
+        # self.segments is the last rewriter's list, already counted there
+        segments = 0 if any(r.segments is self.segments for r in self.rewriters.values()) else self.segments.nbytes()
+        return (media + self.timeline.nbytes() + segments
+                + sum(rewriter.nbytes() for rewriter in self.rewriters.values()))
+
+    def rendition_group(self) -> tuple:
+        """(TYPE, GROUP-ID) of an EXT-X-MEDIA rendition -- a player is on one
+        playlist per group at a time, and on one STREAM-INF variant."""
+        if GROUP_ID in self.mdict:
+            return (self.mdict.get(TYPE), self.mdict[GROUP_ID])
+        return ("STREAM-INF", None)
+
+    def set_segments(self, segments:SegmentList):
+        self.segments = segments
+
+    def get_timeline(self, media:bytes) -> SegmentTimeline:
+        """The segment timeline for this copy of the upstream playlist, indexing only what's new."""
+        if not self.timeline.continues(media):
+            self.timeline = SegmentTimeline()
+        self.timeline.update(media)
+        return self.timeline
+
+    def final(self) -> bool:
+        return self._media_cache.final()
+
     async def get_media(self):
-        await self._gen_media()
-        return self._media
+        # every viewer's player polls this on its own timer -- serve the copy
+        # we have until its target-duration TTL runs out, and coalesce
+        # overlapping refreshes into a single upstream request. with a poller
+        # on it, whatever copy we have is as new as it gets -- unless the
+        # poller hasn't managed to get a new one in a while
+        if self._media_cache.fresh() or self._polled_age_left() > 0:
+            return self._media_cache.text
+
+        return await self.refresh_media_text()
+
+    def _polled_age_left(self) -> float:
+        """Seconds the poller's copy can still be served as is (0 if we're not polled)."""
+        if not self.polled or self._media_cache.text is None:
+            return 0.0
+        max_age = MAX_POLLED_AGE * (target_duration(self._media_cache.text) or DEFAULT_TTL)
+        return max(0.0, self._media_cache.fetched_at + max_age - time.monotonic())
+
+    async def refresh_media(self) -> bool:
+        """Fetch the upstream playlist now, cache or no cache. True if it changed.
+
+        Raises if upstream fails, rather than handing back the old copy.
+        """
+        before = self._media_cache.text
+        return await self._refresh_media() != before
+
+    async def refresh_media_text(self):
+        try:
+            return await self._refresh_media()
+        except Exception as err:
+            if self._media_cache.text is None:
+                raise
+            age = time.monotonic() - self._media_cache.fetched_at
+            logger.warning(f"refreshing {self} failed, serving {age:.1f}s old copy instead: {err}")
+            return self._media_cache.text
+
+    async def _refresh_media(self):
+        # one flight for players and the poller alike, each decides what a failure means
+        return await self.parent_stream._in_flight.do(("media", self.name),
+                                                      lambda: self._media_cache.refresh(self._gen_media, fallback=False))
+
+    async def wait_for_media(self, timeout:float):
+        """Wait until upstream sends a new copy of the playlist, or ours goes stale.
+
+        Either way it's worth looking again -- a stale copy means the next
+        get_media() goes upstream. Gives up quietly after timeout seconds.
+        """
+        if self._media_changed is None:
+            self._media_changed = asyncio.get_running_loop().create_future()
+
+        stale_in = self._polled_age_left() # the poller should fetch it before then
+        if not stale_in:
+            stale_in = self._media_cache.expires_at - time.monotonic()
+        stale_in = max(MIN_MEDIA_WAIT, stale_in)
+        try:
+            await asyncio.wait_for(asyncio.shield(self._media_changed), min(timeout, stale_in))
+        except asyncio.TimeoutError:
+            pass
 
-    async def _gen_media_playlist(self, playlist):
-    
-        if not self.parent_stream._upstream_base_url:
-            await self.parent_stream._gen_master_playlist_url()
+    def _notify_media_changed(self):
+        if self._media_changed is not None:
+            self._media_changed.set_result(None)
+            self._media_changed = None
 
-        target = self.parent_stream._upstream_base_url + playlist
+    async def _gen_media(self):
+
+        stream = self.parent_stream
+        target = await stream.get_upstream_base_url() + self.name
 
         headers = {
             **e.MEDIA_HEADER,
@@ -83,14 +197,20 @@ class Playlist():
         }
 
         logger.info(f"sending media playlist request to {target}")
-        async with self.session.get(target, headers=headers, proxy=self.proxy, ssl=False) as res:
+        async with stream.session.get(target, headers=headers, proxy=stream.proxy, ssl=False) as res:
             if res.status != 200:
                 raise Exception(f"Failed media playlist request: {res.status} {res.reason}")
-            res_text = await res.text()
+            # kept as bytes end to end -- the rewriter works on them directly
+            res_body = await res.read()
 
         try:
-            assert "#EXTM3U" in res_text
+            assert b"#EXTM3U" in res_body
         except Exception as err:
-            logger.error(f"Failed to parse media playlist {playlist} for {self} stream\nresult: {res_text}\n{err}")
-
-        self._variants[playlist]['media'] = res_text
+            logger.error(f"Failed to parse media playlist {self.name} for {stream} stream\nresult: {res_body[:1024]}\n{err}")
+            raise
+
+        changed = res_body != self.media
+        self.media = res_body
+        if changed:
+            self._notify_media_changed()
+        return self.media
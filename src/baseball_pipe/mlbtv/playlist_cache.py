@@ -0,0 +1,99 @@
+import logging
+import math
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+TARGET_DURATION_PATTERN = re.compile(rb"#EXT-X-TARGETDURATION:(\d+(?:\.\d+)?)")
+
+# a live playlist can't change faster than one new segment per target
+# duration, so refreshing at half of it keeps us within half a segment of
+# upstream while cutting our upstream polls to a couple per segment
+LIVE_TTL_FRACTION = 0.5
+# used until we've seen a TARGETDURATION, and as a floor
+DEFAULT_TTL = 1.0
+
+# the master playlist only lists renditions, which don't change for the life
+# of a playback session -- refresh it occasionally, not on every request
+MASTER_PLAYLIST_TTL = 600.0
+
+# after a failed refresh, a fixed-ttl playlist tries upstream again this
+# soon at the latest (a media playlist waits another half target duration)
+FAILED_REFRESH_RETRY = 10.0
+
+def target_duration(text:bytes) -> float:
+    """#EXT-X-TARGETDURATION, which HLS places in the header, or None if there isn't one."""
+    match = TARGET_DURATION_PATTERN.search(text, 0, 1024)
+    if not match:
+        return None
+    return float(match.group(1))
+
+def playlist_ttl(text:bytes) -> float:
+    """How long a fetched media playlist stays good, derived from its own tags.
+
+    Once upstream writes #EXT-X-ENDLIST the playlist is final and never needs
+    to be fetched again. Otherwise it's a fraction of #EXT-X-TARGETDURATION,
+    so only the head and tail get searched.
+    """
+    if b"#EXT-X-ENDLIST" in text[-256:]:
+        return math.inf
+
+    target = target_duration(text)
+    if target is None:
+        return DEFAULT_TTL
+
+    return max(DEFAULT_TTL, target * LIVE_TTL_FRACTION)
+
+class CachedPlaylist():
+    """The last good copy of one upstream playlist, and when to go get a new one."""
+
+    def __init__(self, ttl:float=None):
+        # fixed ttl if given, otherwise derived per fetch from the playlist itself
+        self.ttl = ttl
+        self.text = None
+        self.fetched_at = None
+        self.expires_at = 0.0
+
+    def fresh(self) -> bool:
+        return self.text is not None and time.monotonic() < self.expires_at
+
+    def final(self) -> bool:
+        return self.expires_at == math.inf
+
+    def store(self, text):
+        ttl = self.ttl if self.ttl is not None else playlist_ttl(text)
+        self.text = text
+        self.fetched_at = time.monotonic()
+        self.expires_at = self.fetched_at + ttl
+
+    def expire(self):
+        self.expires_at = 0.0
+
+    def _retry_after(self) -> float:
+        if self.ttl is not None:
+            return min(self.ttl, FAILED_REFRESH_RETRY)
+        return min(playlist_ttl(self.text), FAILED_REFRESH_RETRY)
+
+    async def refresh(self, fetch, fallback:bool=True) -> str:
+        """Refetch via fetch(), falling back to the last good copy if upstream fails.
+
+        With fallback=False the error is raised instead (still backing off,
+        and still keeping the last good copy) for callers that need to know.
+        """
+        try:
+            text = await fetch()
+        except Exception as err:
+            if self.text is None:
+                raise
+            # back off before trying again, or everyone asking for it
+            # (blocked reloads especially) goes straight back upstream
+            now = time.monotonic()
+            self.expires_at = now + self._retry_after()
+            if not fallback:
+                raise
+            logger.warning(f"playlist refresh failed, serving {now - self.fetched_at:.1f}s old copy instead: {err}")
+            return self.text
+
+        self.store(text)
+        return text
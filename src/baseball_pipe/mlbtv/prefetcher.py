@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import os
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from baseball_pipe.mlbtv.stream import Stream
+    from baseball_pipe.mlbtv.media_playlist import Playlist
+    from baseball_pipe.playlist.segment_list import SegmentList
+    from baseball_pipe.mlbtv.viewer_registry import ViewerEvent
+
+logger = logging.getLogger(__name__)
+
+# how far ahead of the player to warm the segment cache -- by count, and
+# optionally capped by seconds of media (0 means count only)
+PREFETCH_SEGMENTS = int(os.environ.get("bbp_prefetch_segments", 3))
+PREFETCH_SECONDS = float(os.environ.get("bbp_prefetch_seconds", 0))
+PREFETCH_CONCURRENCY = int(os.environ.get("bbp_prefetch_concurrency", 4))
+
+class Prefetcher():
+    """Warms the segment cache with the segments a player is about to ask for.
+
+    Works off the segment list each rewritten media playlist leaves on its
+    Playlist (see stream_mangler), which only has the real segments that
+    survived the rewrite -- ad segments swapped out for filler never show up
+    there, so they're never fetched.
+    """
+
+    def __init__(self,
+                 segments:int=PREFETCH_SEGMENTS,
+                 seconds:float=PREFETCH_SECONDS,
+                 concurrency:int=PREFETCH_CONCURRENCY):
+
+        self.segments = segments
+        self.seconds = seconds
+        self.concurrency = concurrency
+
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._pending = set() # (stream id, path) waiting on or holding the semaphore
+        self._tasks = {} # (stream id, path) -> asyncio.Task
+
+        self.warmed = 0
+        self.failed = 0
+
+    def upcoming(self, segments:"SegmentList", start:int) -> list:
+        """Paths of segments[start:] the player will want next, within the count/seconds budget."""
+        paths = []
+        seconds = 0.0
+        for path, duration in segments.items(start, start + self.segments):
+            if self.seconds and seconds >= self.seconds:
+                break
+            paths.append(path)
+            seconds += duration
+        return paths
+
+    def on_playlist(self, stream:"Stream", playlist:"Playlist", new_segments:int):
+        """After a rewrite: warm whatever just appeared at the live edge."""
+        if not self.segments or new_segments <= 0 or stream.get_playlist_type() == "vod":
+            return
+
+        start = max(len(playlist.segments) - new_segments, len(playlist.segments) - self.segments)
+        self.warm(stream, self.upcoming(playlist.segments, start))
+
+    def on_segment(self, stream:"Stream", path:str):
+        """After a segment request: warm the next few segments in the same variant."""
+        if not self.segments:
+            return
+
+        for playlist in stream.get_loaded_variants():
+            index = playlist.segments.index(path)
+            if index is not None:
+                self.warm(stream, self.upcoming(playlist.segments, index + 1))
+                return
+
+    def warm(self, stream:"Stream", paths:list):
+        if stream.segment_cache is None:
+            return
+
+        for path in paths:
+            key = (str(stream), path)
+            if key in self._pending or stream.segment_cached(path) or stream.segment_in_flight(path):
+                continue
+
+            # a player seeking around a VOD can queue up more than we'll
+            # ever get to -- don't let the backlog grow past a few rounds
+            if len(self._pending) >= self.concurrency * 4:
+                logger.debug(f"prefetch backlog full, skipping {stream}/{path}")
+                return
+
+            self._pending.add(key)
+            task = asyncio.ensure_future(self._warm(stream, path, key))
+            self._tasks[key] = task
+            task.add_done_callback(lambda t, key=key: self._tasks.pop(key, None))
+
+    async def _warm(self, stream:"Stream", path:str, key):
+        try:
+            async with self._semaphore:
+                if stream.segment_cached(path):
+                    return
+                await stream.get_segment(path)
+                self.warmed += 1
+                logger.debug(f"prefetched {stream}/{path}")
+        except Exception as err:
+            self.failed += 1
+            logger.warning(f"failed to prefetch {stream}/{path}: {err}")
+        finally:
+            self._pending.discard(key)
+
+    def forget(self, stream_id:str):
+        """Drop every prefetch queued for stream_id.
+
+        One already fetching only stops waiting -- the upstream GET is
+        shared (see SingleFlight) and finishes into the cache regardless.
+        """
+        tasks = [task for key, task in self._tasks.items() if key[0] == stream_id]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            logger.debug(f"cancelled {len(tasks)} prefetches for {stream_id}")
+
+    def on_viewer_leave(self, event:"ViewerEvent"):
+        # nobody left to play what we'd be warming
+        if not event.stream_viewers:
+            self.forget(event.stream_id)
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,152 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from baseball_pipe.mlbtv.viewer_registry import ViewerEvent
+
+logger = logging.getLogger(__name__)
+
+# total payload bytes held across every stream, not an entry count -- a 1080p
+# segment is a few MB while a .key is 16 bytes, so counting entries would
+# make the real memory ceiling depend on which renditions people are watching
+DEFAULT_MAX_BYTES = int(os.environ.get("bbp_segment_cache_mb", 512)) * 1024 * 1024
+
+# keys and init data are reused for the whole session, live media segments
+# only matter while they're near the edge everybody is watching
+SEGMENT_TTLS = {
+    ".key": 3600,
+    ".mp4": 3600,
+    ".ts": 120,
+    ".aac": 120,
+    ".m4s": 120,
+    ".vtt": 120,
+}
+DEFAULT_TTL = 60
+
+# free a stream's segments as soon as its last viewer leaves, instead of
+# letting them sit until they expire or get pushed out
+EVICT_UNWATCHED = os.environ.get("bbp_evict_unwatched", "1") != "0"
+
+def normalize_key(stream_id:str, path:str) -> str:
+    """Build the cache key for a segment path, dropping any query tokens.
+
+    Upstream hands out per-session tokens in the query string, so two viewers
+    on different playback sessions still resolve to the same segment here.
+    """
+    path = path.split("?", 1)[0].split("#", 1)[0]
+    return f"{stream_id}/{path.lstrip('/')}"
+
+def segment_ttl(path:str) -> float:
+    path = path.split("?", 1)[0].lower()
+    if "init" in path.rsplit("/", 1)[-1]:
+        return SEGMENT_TTLS[".mp4"]
+    return SEGMENT_TTLS.get(os.path.splitext(path)[1], DEFAULT_TTL)
+
+class SegmentCache():
+
+    def __init__(self, max_bytes:int=DEFAULT_MAX_BYTES, max_entry_bytes:int=None):
+        self.max_bytes = max_bytes
+        # a single entry bigger than this would just flush everything else out
+        self.max_entry_bytes = max_entry_bytes or max_bytes // 8
+
+        self._entries = OrderedDict() # key -> (data, expires_at)
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        logger.info(f"segment cache initialized with {self.max_bytes // (1024 * 1024)}MB limit")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self._peek(key) is not None
+
+    def _peek(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        data, expires_at = entry
+        if expires_at <= time.monotonic():
+            self._drop(key)
+            self.expirations += 1
+            return None
+
+        return data
+
+    def _drop(self, key):
+        data, _ = self._entries.pop(key)
+        self._bytes -= len(data)
+
+    def get(self, key):
+        data = self._peek(key)
+        if data is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key, data:bytes, ttl:float=None):
+        size = len(data)
+        if size > self.max_entry_bytes:
+            logger.debug(f"not caching {key}, {size} bytes is over the {self.max_entry_bytes} byte entry limit")
+            return
+
+        if key in self._entries:
+            self._drop(key)
+
+        if ttl is None:
+            ttl = segment_ttl(key)
+
+        self._entries[key] = (bytes(data), time.monotonic() + ttl)
+        self._bytes += size
+
+        while self._bytes > self.max_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def discard(self, key):
+        if key in self._entries:
+            self._drop(key)
+
+    def discard_stream(self, stream_id:str) -> int:
+        """Drop everything cached for stream_id, returning how many bytes that freed."""
+        prefix = f"{stream_id}/"
+        freed = 0
+        for key in [key for key in self._entries if key.startswith(prefix)]:
+            freed += len(self._entries[key][0])
+            self._drop(key)
+        return freed
+
+    def on_viewer_leave(self, event:"ViewerEvent"):
+        if EVICT_UNWATCHED and not event.stream_viewers:
+            freed = self.discard_stream(event.stream_id)
+            if freed:
+                logger.info(f"nobody's watching {event.stream_id}, freed {freed // 1024}KB of cached segments")
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
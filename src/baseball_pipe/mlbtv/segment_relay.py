@@ -0,0 +1,68 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 64KB matches aiohttp's own read buffer, so chunks go out as they land
+SEGMENT_CHUNK_SIZE = 64 * 1024
+
+# how far the upstream read may run ahead of a slow player before it waits
+RELAY_QUEUE_CHUNKS = 8
+
+class SegmentRelay():
+    """Hand-off between the task reading a segment from upstream and the handler writing it out.
+
+    The upstream read runs as its own task so it can outlive the player that
+    started it (other players may be waiting on the same bytes). The handler
+    only ever holds RELAY_QUEUE_CHUNKS chunks at a time; once it detaches, the
+    upstream side stops queueing and either finishes into the cache or quits.
+    """
+
+    def __init__(self, max_chunks:int=RELAY_QUEUE_CHUNKS):
+        self._queue = asyncio.Queue(maxsize=max_chunks)
+        self._started = asyncio.get_running_loop().create_future()
+        self._error = None
+        self.detached = False
+
+    # UPSTREAM SIDE
+    def open(self, content_length):
+        if not self._started.done():
+            self._started.set_result(content_length)
+
+    async def feed(self, chunk:bytes):
+        if not self.detached:
+            await self._queue.put(chunk)
+
+    async def close(self, err:Exception=None):
+        self._error = err
+        if not self._started.done():
+            if err:
+                self._started.set_exception(err)
+                self._started.exception() # handler may already be gone, don't warn about it
+            else:
+                self._started.set_result(None)
+            return
+
+        if not self.detached:
+            await self._queue.put(None)
+
+    # HANDLER SIDE
+    async def start(self):
+        """Wait for upstream response headers, returns Content-Length if upstream sent one."""
+        return await self._started
+
+    async def chunks(self):
+        while True:
+            chunk = await self._queue.get()
+            if chunk is None:
+                break
+            yield chunk
+
+        if self._error:
+            raise self._error
+
+    def detach(self):
+        self.detached = True
+        # free up the queue in case the upstream side is parked on a full put()
+        while not self._queue.empty():
+            self._queue.get_nowait()
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import os
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from baseball_pipe.mlbtv.stream import Stream
+    from baseball_pipe.mlbtv.viewer_registry import ViewerRegistry
+
+logger = logging.getLogger(__name__)
+
+# renew a watched stream's playback session in the background this many
+# seconds before it expires, instead of letting a player's request find it expired
+RENEW_SESSIONS = os.environ.get("bbp_renew_sessions", "1") != "0"
+RENEW_BEFORE = float(os.environ.get("bbp_renew_before", 300))
+
+# wait between failed renewals, and the least we'll ever sleep
+RENEW_RETRY = 30.0
+MIN_RENEW_WAIT = 5.0
+
+class SessionRenewer():
+    """One background task per stream, renewing its playback session ahead of expiration.
+
+    A stream's task starts with the first request for it (see watch()) and
+    sleeps until lead seconds before the session expires (or halfway there,
+    for a session shorter than that). If anybody's watching the stream by
+    then it calls Stream.renew(), which swaps the new session in without a
+    player ever waiting on initPlaybackSession. If nobody is, the session
+    is left to lapse -- the next request for it replaces the stream as usual.
+    """
+
+    def __init__(self, viewers:"ViewerRegistry", lead:float=RENEW_BEFORE):
+        self.viewers = viewers
+        self.lead = lead
+
+        self._tasks = {}   # str(stream) -> asyncio.Task
+        self._streams = {} # str(stream) -> the Stream being renewed
+
+        self.renewals = 0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def watch(self, stream:"Stream"):
+        key = str(stream)
+        task = self._tasks.get(key)
+        if task is not None and self._streams.get(key) is stream:
+            return
+
+        # the stream was replaced, renew the new one instead
+        if task is not None:
+            task.cancel()
+
+        task = asyncio.ensure_future(self._renew(stream))
+        self._tasks[key] = task
+        self._streams[key] = stream
+        task.add_done_callback(lambda t: self._done(key, t))
+
+    def forget(self, stream_id:str):
+        task = self._tasks.get(stream_id)
+        if task is not None:
+            task.cancel()
+
+    def _done(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+            self._streams.pop(key, None)
+        if not task.cancelled() and task.exception():
+            logger.error(f"session renewer for {key} died: {task.exception()}")
+
+    async def _renew(self, stream:"Stream"):
+        failures = 0
+        while True:
+            remaining = stream.seconds_until_expired()
+            if remaining is None:
+                return
+
+            if failures:
+                wait = RENEW_RETRY
+            else:
+                wait = remaining - min(self.lead, remaining / 2)
+            await asyncio.sleep(max(MIN_RENEW_WAIT, wait))
+
+            if not self.viewers.count(str(stream)):
+                logger.info(f"nobody's watching {stream}, letting its playback session lapse")
+                return
+
+            try:
+                await stream.renew()
+                self.renewals += 1
+                failures = 0
+            except Exception as err:
+                self.failed += 1
+                failures += 1
+                logger.warning(f"playback session renewal for {stream} failed ({failures} in a row): {err}")
+                if stream.is_expired():
+                    return
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,16 +1,39 @@
+import asyncio
 import logging
 import re
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING
 from datetime import datetime, timezone
 import baseball_pipe.mlb.mlb_stats
 from baseball_pipe.mlbtv.token import Token
 
 from baseball_pipe.misc import utilities as u
 from baseball_pipe.misc import header_handler as e
+from baseball_pipe.misc.single_flight import SingleFlight
 from baseball_pipe.playlist import generate_filler_segments as gfs
+from baseball_pipe.playlist.ad_breaks import AdBreakMap
 from baseball_pipe.mlbtv import media_playlist
+from baseball_pipe.mlbtv.segment_cache import SegmentCache, normalize_key
+from baseball_pipe.mlbtv.prefetcher import Prefetcher
+from baseball_pipe.mlbtv.playlist_cache import CachedPlaylist, MASTER_PLAYLIST_TTL
+from baseball_pipe.mlbtv.segment_relay import SegmentRelay, SEGMENT_CHUNK_SIZE
 import aiohttp
 
+if TYPE_CHECKING:
+    from baseball_pipe.playlist.playlist_poller import PlaylistPoller
+    from baseball_pipe.mlbtv.viewer_registry import ViewerRegistry
+
 GRAPHQL_URL = "https://media-gateway.mlb.com/graphql"
+
+SEGMENT_HEADERS = {
+    **e.MEDIA_HEADER,
+    "Accept": "*/*",
+    "Accept-Encoding": "identity;q=1, *;q=0",
+    "Sec-Fetch-Dest": "video",
+    "Sec-Fetch-Mode": "no-cors",
+    "Sec-Fetch-Site": "same-origin",
+}
+
 logger = logging.getLogger(__name__)
 
 class Stream():
@@ -20,7 +43,11 @@ class Stream():
                  game_pk:str,
                  media_id:str,
                  session:aiohttp.ClientSession,
-                 proxy:str = None):
+                 proxy:str = None,
+                 segment_cache:SegmentCache = None,
+                 prefetcher:Prefetcher = None,
+                 poller:"PlaylistPoller" = None,
+                 viewers:"ViewerRegistry" = None):
         
         self.token = token
         self.game_pk = game_pk
@@ -28,6 +55,13 @@ class Stream():
         self.url = "https://www.mlb.com/tv/g%s/v%s" % (self.game_pk, self.media_id)
         self.session = session
         self.proxy = proxy
+        self.segment_cache = segment_cache
+        self.prefetcher = prefetcher
+        self.poller = poller
+        self.viewers = viewers
+
+        # concurrent players asking for the same segment/playlist share one upstream GET
+        self._in_flight = SingleFlight()
 
         self.reset()
 
@@ -52,10 +86,14 @@ class Stream():
 
         # via _gen_master_playlist()
         self._master_playlist = None
+        self._master_cache = CachedPlaylist(ttl=MASTER_PLAYLIST_TTL)
 
         # via _gen_variants()
         self._variants = None
 
+        # cue-out/cue-in intervals, measured once and shared by every variant
+        self.ad_breaks = AdBreakMap()
+
     def __str__(self):
         return f"{self.game_pk}/{self.media_id}"
     
@@ -78,8 +116,9 @@ class Stream():
         return self._master_playlist_url
 
     async def get_master_playlist(self):
-        await self._gen_master_playlist()
-        return self._master_playlist
+        if not self._master_cache.fresh():
+            await self._in_flight.do(("master",), lambda: self._master_cache.refresh(self._gen_master_playlist))
+        return self._master_cache.text
 
     async def get_variant(self, name):
         if not self._variants:
@@ -87,17 +126,56 @@ class Stream():
 
         return self._variants.get(name, None)
 
+    def get_loaded_variants(self):
+        return list(self._variants.values()) if self._variants else []
+
+    def segment_variant(self, path):
+        """The variant whose last rewrite kept segment path, if any."""
+        for playlist in self.get_loaded_variants():
+            if playlist.segments.index(path) is not None:
+                return playlist
+        return None
+
     async def get_upstream_base_url(self):
         if not self._upstream_base_url:
             await self._gen_master_playlist_url()
 
         return self._upstream_base_url
 
+    def nbytes(self) -> int:
+        """Roughly what this stream's playlists cost in memory (segments are the cache's)."""
+        master = len(self._master_playlist or "")
+        if self._master_cache.text is not self._master_playlist:
+            master += len(self._master_cache.text or "")
+        return master + sum(playlist.nbytes() for playlist in self.get_loaded_variants())
+
+    def segment_cached(self, path) -> bool:
+        return self.segment_cache is not None and normalize_key(str(self), path) in self.segment_cache
+
+    def segment_in_flight(self, path) -> bool:
+        return self._in_flight.in_flight(("segment", normalize_key(str(self), path)))
+
     async def get_segment(self, path):
+        key = normalize_key(str(self), path)
+
+        if self.segment_cache is not None:
+            data = self.segment_cache.get(key)
+            if data is not None:
+                logger.debug(f"segment cache hit for {key}")
+                return data
+
+        return await self._in_flight.do(("segment", key), lambda: self._cache_segment(path, key))
+
+    async def _cache_segment(self, path, key):
         if not self._upstream_base_url:
             await self._gen_master_playlist_url()
 
-        return await self._gen_segment(path)
+        data = await self._gen_segment(path)
+
+        if self.segment_cache is not None:
+            self.segment_cache.put(key, data)
+
+        return data
 
     async def get_start(self):
         if not self._start:
@@ -115,13 +193,19 @@ class Stream():
         expiration = expiration.replace('Z', '+00:00') if expiration.endswith('Z') else expiration
         return datetime.fromisoformat(expiration)
 
+    def seconds_until_expired(self) -> float:
+        """Seconds left on the playback session, None if there isn't one yet."""
+        if not self._expiration:
+            return None
+        expiration = self._parse_expiration(self._expiration)
+        return (expiration - datetime.now(timezone.utc)).total_seconds()
+
     def is_expired(self) -> bool:
         if not self._expiration:
             return False
 
         try:
-            expiration = self._parse_expiration(self._expiration)
-            seconds_until_expired = round((expiration - datetime.now(timezone.utc)).total_seconds())
+            seconds_until_expired = round(self.seconds_until_expired())
             logger.debug(f"stream {self} expires in {seconds_until_expired} seconds")
             return seconds_until_expired <= 30
         except Exception as err:
@@ -186,7 +270,39 @@ class Stream():
             logger.error(f"Failed to parse session for {self} stream: {err}")
             raise err
         
+    async def renew(self):
+        """Start a new playback session ahead of this one expiring, keeping everything else.
+
+        The new master playlist URL, expiration and upstream base URL are
+        swapped in together once the new session is up. Requests already
+        sent on the old session just finish on it -- it's good until its
+        own expiration -- and the variants, rewriters and caches carry on
+        since variant paths are relative to the base URL.
+        """
+        try:
+            playback = await self._init_playback_session()
+        except Exception as err:
+            # the device session may be what went stale, start over from it once
+            logger.warning(f"playback session renewal for {self} failed, retrying with a new session: {err}")
+            await self._gen_session()
+            playback = await self._init_playback_session()
+
+        self._set_playback(*playback)
+        logger.info(f"renewed playback session for {self}, now expires {self._expiration}")
+
+        # refetch the master from the new session now, not on a player's request
+        await self._in_flight.do(("master",), lambda: self._master_cache.refresh(self._gen_master_playlist))
+
+    def _set_playback(self, master_playlist_url:str, expiration:str):
+        self._master_playlist_url = master_playlist_url
+        self._expiration = expiration
+        self._upstream_base_url = master_playlist_url.rsplit('/', 1)[0] + '/'
+
     async def _gen_master_playlist_url(self):
+        self._set_playback(*await self._init_playback_session())
+
+    async def _init_playback_session(self) -> tuple:
+        """(master playlist URL, expiration) of a new playback session."""
 
         if not self._session_id:
             await self._gen_session()
@@ -265,9 +381,8 @@ class Stream():
             raise Exception(error_message)
 
         try:
-            self._master_playlist_url = res_json["data"]["initPlaybackSession"]["playback"]["url"]
-            self._expiration = res_json["data"]["initPlaybackSession"]["playback"]["expiration"]
-            self._upstream_base_url = self._master_playlist_url.rsplit('/', 1)[0] + '/'
+            playback = res_json["data"]["initPlaybackSession"]["playback"]
+            return playback["url"], playback["expiration"]
         except(KeyError, TypeError) as err:
             logger.error(f"Failed to parse master playlist url for {self} stream: {err}")
             raise err
@@ -295,15 +410,19 @@ class Stream():
                 raise Exception(f"Failed master playlist request: {res.status} {res.reason}")
             res_text = await res.text()
 
-        self._master_playlist = res_text
         try:
-            assert "#EXTM3U" in self._master_playlist
+            assert "#EXTM3U" in res_text
         except Exception as err:
             logger.error(f"Failed to parse master playlist for {self} stream\n{res_text}\n{err}")
+            raise
+
+        self._master_playlist = res_text
 
         if not self._variants:
             await self._gen_variants()
 
+        return res_text
+
     async def _gen_variants(self):
 
         if not self._master_playlist:
@@ -328,7 +447,7 @@ class Stream():
                     pairs = re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]+)', line)
                     media_dict = {k.lower(): v.strip('"') for k, v in pairs}
 
-                    name = media_dict.pop("URI")
+                    name = media_dict.pop("uri")
                     self._variants[name] = media_playlist.Playlist(self, name, media_dict)
 
         except Exception as err:
@@ -341,17 +460,63 @@ class Stream():
 
         target = self._upstream_base_url + path
 
-        headers = {
-            **e.MEDIA_HEADER,
-            "Accept": "*/*",
-            "Accept-Encoding": "identity;q=1, *;q=0",
-            "Sec-Fetch-Dest": "video",
-            "Sec-Fetch-Mode": "no-cors",
-            "Sec-Fetch-Site": "same-origin",
-        }
-
         logger.info(f"sending segment request to {target}")
-        async with self.session.get(target, headers=headers, proxy=self.proxy, ssl=False) as res:
+        async with self.session.get(target, headers=SEGMENT_HEADERS, proxy=self.proxy, ssl=False) as res:
             if res.status != 200:
                 raise Exception(f"Failed segment request: {res.status} {res.reason}")
-            return await res.read()
\ No newline at end of file
+            return await res.read()
+
+    @asynccontextmanager
+    async def relay_segment(self, path):
+        """Start streaming a segment from upstream, yielding a SegmentRelay to read it from.
+
+        With a segment cache the upstream read is teed into it and registered
+        as the in-flight fetch for the segment, so get_segment() callers that
+        arrive mid-relay share it rather than going upstream again.
+        """
+        key = normalize_key(str(self), path)
+        relay = SegmentRelay()
+        task = asyncio.ensure_future(self._relay_segment(path, key, relay))
+
+        if self.segment_cache is not None:
+            self._in_flight.track(("segment", key), task)
+        else:
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+        try:
+            yield relay
+        finally:
+            relay.detach()
+
+    async def _relay_segment(self, path, key, relay:SegmentRelay):
+        tee = bytearray() if self.segment_cache is not None else None
+
+        try:
+            target = await self.get_upstream_base_url() + path
+
+            logger.info(f"sending relayed segment request to {target}")
+            async with self.session.get(target, headers=SEGMENT_HEADERS, proxy=self.proxy, ssl=False) as res:
+                if res.status != 200:
+                    raise Exception(f"Failed segment request: {res.status} {res.reason}")
+
+                relay.open(res.content_length)
+                async for chunk in res.content.iter_chunked(SEGMENT_CHUNK_SIZE):
+                    if tee is not None:
+                        tee += chunk
+                    elif relay.detached:
+                        logger.debug(f"player left mid-relay, dropping {target}")
+                        return None
+                    await relay.feed(chunk)
+
+        except Exception as err:
+            await relay.close(err)
+            raise
+
+        await relay.close()
+
+        if tee is None:
+            return None
+
+        data = bytes(tee)
+        self.segment_cache.put(key, data)
+        return data
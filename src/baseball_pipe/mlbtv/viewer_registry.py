@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# a player polls its media playlist every few seconds and pulls a segment
+# about as often, so this long without either means it's gone
+VIEWER_IDLE_TIMEOUT = float(os.environ.get("bbp_viewer_idle", 30))
+
+class ViewerEvent():
+    """A viewer joining or leaving a stream or one of its variants, with the counts after it.
+
+    variant is None for the stream itself -- a viewer's first request
+    joins the stream, and it leaves the stream once it's gone quiet
+    altogether, after leaving each variant it was on.
+    """
+
+    def __init__(self, stream_id:str, variant:str, viewer, stream_viewers:int, variant_viewers:int):
+        self.stream_id = stream_id
+        self.variant = variant
+        self.viewer = viewer
+        self.stream_viewers = stream_viewers
+        self.variant_viewers = variant_viewers
+
+    def __repr__(self):
+        return f"ViewerEvent({self.stream_id}/{self.variant}, {self.viewer}, {self.stream_viewers} on stream, {self.variant_viewers} on variant)"
+
+class ViewerRegistry():
+    """Who's watching what, going by their playlist and segment requests.
+
+    A viewer is one player (remote address and user agent) on one stream.
+    It's on every media playlist it keeps asking for (or pulling segments
+    of) -- a video variant plus its audio and subtitle renditions, say --
+    each with its own last-seen time. It leaves a playlist when that goes
+    quiet for idle_timeout seconds, or straight away when it asks for
+    another playlist in the same group (an adaptive player switching video
+    variants, or audio languages), and leaves the stream once it's gone
+    quiet altogether.
+
+    Anything that should only spend upstream bandwidth or memory on streams
+    somebody's watching subscribes to the join/leave events; callbacks get
+    a ViewerEvent and run synchronously, so they must not block.
+    """
+
+    def __init__(self, idle_timeout:float=VIEWER_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+
+        self._viewers = {}        # (stream id, viewer) -> [last seen, {variant: [group, last seen]}]
+        self._stream_counts = {}  # stream id -> viewers
+        self._variant_counts = {} # (stream id, variant) -> viewers
+
+        self._on_join = []
+        self._on_leave = []
+        self._sweeper = None
+
+    def __len__(self):
+        return len(self._viewers)
+
+    def subscribe(self, on_join=None, on_leave=None):
+        if on_join:
+            self._on_join.append(on_join)
+        if on_leave:
+            self._on_leave.append(on_leave)
+
+    def count(self, stream_id:str, variant:str=None) -> int:
+        """Viewers on a stream, or on one of its variants."""
+        if variant is None:
+            return self._stream_counts.get(stream_id, 0)
+        return self._variant_counts.get((stream_id, variant), 0)
+
+    def counts(self) -> dict:
+        """{stream id: {"viewers": n, "variants": {variant: n}}} for everything being watched."""
+        counts = {stream_id: {"viewers": n, "variants": {}} for stream_id, n in self._stream_counts.items()}
+        for (stream_id, variant), n in self._variant_counts.items():
+            counts[stream_id]["variants"][variant] = n
+        return counts
+
+    def touch(self, stream_id:str, viewer, variant:str=None, group=None):
+        """viewer just asked for something from stream_id -- of variant, if known.
+
+        group is what variant is one of (e.g. its TYPE and GROUP-ID), if
+        known: the viewer leaves any other variant it's on in the same group.
+        """
+        self._start_sweeper()
+
+        now = time.monotonic()
+        key = (stream_id, viewer)
+        entry = self._viewers.get(key)
+        if entry is None:
+            entry = self._viewers[key] = [now, {}]
+            self._join(stream_id, None, viewer)
+        entry[0] = now
+
+        if variant is None:
+            return
+
+        variants = entry[1]
+        seen = variants.get(variant)
+        if seen is not None:
+            seen[1] = now
+            if group is not None:
+                seen[0] = group
+            return
+
+        if group is not None:
+            for other, (other_group, _) in list(variants.items()):
+                if other_group == group:
+                    del variants[other]
+                    self._leave(stream_id, other, viewer)
+        variants[variant] = [group, now]
+        self._join(stream_id, variant, viewer)
+
+    def expire(self):
+        """Drop every playlist, and every viewer, that's been quiet for idle_timeout."""
+        cutoff = time.monotonic() - self.idle_timeout
+        for key, (last_seen, variants) in list(self._viewers.items()):
+            stream_id, viewer = key
+            gone = last_seen < cutoff
+            for variant, (_, variant_seen) in list(variants.items()):
+                if gone or variant_seen < cutoff:
+                    del variants[variant]
+                    self._leave(stream_id, variant, viewer)
+            if gone:
+                del self._viewers[key]
+                self._leave(stream_id, None, viewer)
+
+    def _join(self, stream_id:str, variant:str, viewer):
+        if variant is None:
+            self._stream_counts[stream_id] = self._stream_counts.get(stream_id, 0) + 1
+        else:
+            self._variant_counts[(stream_id, variant)] = self._variant_counts.get((stream_id, variant), 0) + 1
+
+        event = ViewerEvent(stream_id, variant, viewer, self.count(stream_id), self.count(stream_id, variant) if variant else 0)
+        logger.debug(f"viewer joined: {event}")
+        self._emit(self._on_join, event)
+
+    def _leave(self, stream_id:str, variant:str, viewer):
+        counts, key = (self._stream_counts, stream_id) if variant is None else (self._variant_counts, (stream_id, variant))
+        counts[key] -= 1
+        if not counts[key]:
+            del counts[key]
+
+        event = ViewerEvent(stream_id, variant, viewer, self.count(stream_id), self.count(stream_id, variant) if variant else 0)
+        logger.debug(f"viewer left: {event}")
+        self._emit(self._on_leave, event)
+
+    def _emit(self, callbacks:list, event:ViewerEvent):
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception as err:
+                logger.error(f"viewer event callback {callback} failed for {event}: {err}")
+
+    def _start_sweeper(self):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.ensure_future(self._sweep())
+
+    async def _sweep(self):
+        while self._viewers:
+            await asyncio.sleep(self.idle_timeout / 2)
+            self.expire()
+
+    async def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
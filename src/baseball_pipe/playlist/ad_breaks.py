@@ -0,0 +1,134 @@
+import logging
+from bisect import bisect_left
+
+from baseball_pipe.playlist.timeline import SegmentTimeline, MICROS
+
+logger = logging.getLogger(__name__)
+
+CUE_OUT_TAG = b"#EXT-X-CUE-OUT:"
+CUE_IN_TAG = b"#EXT-X-CUE-IN"
+
+# renditions of one stream share PROGRAM-DATE-TIMEs, but audio segments don't
+# always line up with video to the millisecond -- a break (or a segment) in
+# one variant matches another's within this much
+MATCH_TOLERANCE = MICROS
+
+class AdBreak():
+    """One ad break, placed by program date time (epoch microseconds)."""
+
+    def __init__(self, start:int, expected:float):
+        self.start = start
+        self.expected = expected # seconds, from CUE-OUT
+        self.end = None          # None while the break is still open at the live edge
+        self.observed = 0.0      # seconds of ad segments upstream actually sent
+
+    def __repr__(self):
+        return f"AdBreak(start={self.start}, expected={self.expected}, end={self.end}, observed={self.observed:.3f})"
+
+    def closed(self) -> bool:
+        return self.end is not None
+
+class AdBreakMap():
+    """Every ad break in a stream, shared by all of its variants.
+
+    The renditions of a stream all carry the same breaks at the same program
+    date times, so there's no point working them out once per variant. The
+    map only ever extends forward: whichever variant has indexed the most
+    segments fills in the stretch of time past what's covered, everyone else
+    just looks breaks up -- so each break is measured exactly once, and every
+    variant splices in the same filler for it.
+    """
+
+    def __init__(self):
+        self.breaks = []
+        self.starts = [] # breaks[i].start, for bisection
+        self.covered_until = None # epoch micros, end of the last segment scanned
+
+    def __len__(self):
+        return len(self.breaks)
+
+    def find(self, micros:int) -> AdBreak:
+        """The break starting at micros (give or take MATCH_TOLERANCE), if there is one."""
+        i = bisect_left(self.starts, micros - MATCH_TOLERANCE)
+        if i < len(self.breaks) and self.breaks[i].start <= micros + MATCH_TOLERANCE:
+            return self.breaks[i]
+        return None
+
+    def open_break(self) -> AdBreak:
+        if self.breaks and not self.breaks[-1].closed():
+            return self.breaks[-1]
+        return None
+
+    def update(self, media:bytes, timeline:SegmentTimeline):
+        """Pick up cues from whatever part of this variant's timeline the map doesn't cover yet."""
+        if not timeline.timed or not len(timeline):
+            return
+        if self.covered_until is not None and timeline.end() <= self.covered_until:
+            return
+
+        first = 0
+        if self.covered_until is not None:
+            first = bisect_left(timeline.start, self.covered_until - MATCH_TOLERANCE)
+            # only the segments starting at or past the covered edge are new
+            while first < len(timeline) and timeline.segment_end(first) <= self.covered_until + MATCH_TOLERANCE:
+                first += 1
+
+        offsets = timeline.offset
+        position = offsets[first] if first < len(timeline) else timeline.scanned
+        # a cue sits in the block of the segment it comes before; one past the
+        # last indexed segment waits until that segment turns up
+        limit = timeline.scanned
+
+        cue_out = media.find(CUE_OUT_TAG, position, limit)
+        cue_in = media.find(CUE_IN_TAG, position, limit)
+        while cue_out != -1 or cue_in != -1:
+            if cue_in == -1 or (cue_out != -1 and cue_out < cue_in):
+                index = bisect_left(offsets, cue_out + 1) - 1
+                if index >= 0:
+                    self._cue_out(media, cue_out, timeline, index)
+                cue_out = media.find(CUE_OUT_TAG, cue_out + 1, limit)
+            else:
+                index = bisect_left(offsets, cue_in + 1) - 1
+                if index >= 0:
+                    self._cue_in(timeline, index)
+                cue_in = media.find(CUE_IN_TAG, cue_in + 1, limit)
+
+        self.covered_until = timeline.end()
+
+    def _cue_out(self, media:bytes, cue:int, timeline:SegmentTimeline, index:int):
+        if self.open_break():
+            logger.warning(f"CUE-OUT at {timeline.start[index]} while a break is still open, closing it")
+            self._cue_in(timeline, index)
+
+        line_end = media.find(b"\n", cue)
+        try:
+            expected = float(media[cue + len(CUE_OUT_TAG):line_end if line_end != -1 else None].strip() or 0)
+        except ValueError as err:
+            logger.error(f"failed to parse CUE-OUT duration at {timeline.start[index]}: {err}")
+            expected = 0.0
+
+        ad_break = AdBreak(timeline.start[index], expected)
+        self.breaks.append(ad_break)
+        self.starts.append(ad_break.start)
+
+    def _cue_in(self, timeline:SegmentTimeline, index:int):
+        ad_break = self.open_break()
+        if ad_break is None:
+            logger.warning(f"CUE-IN at {timeline.start[index]} without a CUE-OUT")
+            return
+
+        # may not be the variant that saw the CUE-OUT, so find the break's
+        # first segment again by time
+        first = bisect_left(timeline.start, ad_break.start - MATCH_TOLERANCE)
+
+        # summed segment by segment, same as a rewriter adding up EXTINFs
+        observed = 0.0
+        for duration in timeline.duration[first:index]:
+            observed += duration
+
+        ad_break.observed = observed
+        ad_break.end = timeline.segment_end(index - 1) if index > 0 else ad_break.start
+
+        if abs(observed - ad_break.expected) > 1:
+            logger.warning(f"mismatch between expected ad duration ({ad_break.expected}) and actual ad elapsed ({observed})")
+        logger.debug(f"ad break {ad_break}")
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import os
+import time
+from typing import TYPE_CHECKING
+
+from baseball_pipe.mlbtv.playlist_cache import target_duration
+from baseball_pipe.playlist.stream_mangler import rewrite_media_playlist, DEFAULT_TARGET_DURATION
+
+if TYPE_CHECKING:
+    from baseball_pipe.mlbtv.stream import Stream
+    from baseball_pipe.mlbtv.media_playlist import Playlist
+    from baseball_pipe.mlbtv.viewer_registry import ViewerEvent
+
+logger = logging.getLogger(__name__)
+
+# keep following upstream in the background while someone's watching a
+# variant, so a player's poll is a memory read instead of an upstream round trip
+POLL_PLAYLISTS = os.environ.get("bbp_poll_playlists", "1") != "0"
+# stop a variant's poller after this many seconds without a player asking for it
+POLL_IDLE_TIMEOUT = float(os.environ.get("bbp_poll_idle", 60))
+
+# same as a player's own reload rule: a target duration after upstream
+# changed, half of one after it didn't
+UNCHANGED_FRACTION = 0.5
+# back off this far (in target durations) while upstream keeps failing
+MAX_FAILURE_BACKOFF = 4
+
+class PlaylistPoller():
+    """One background task per watched variant, following its upstream media playlist.
+
+    A variant's poller starts with the first player request for it (see
+    watch()) and refetches the upstream playlist at the pace upstream adds
+    segments. Every own_base the variant has a rewriter for gets rewritten
+    right away, so the next player poll finds its output ready. While a
+    poller's running the Playlist serves its cached copy until it's a few
+    target durations old (see Playlist.get_media()), so upstream sees one
+    fetch per target duration however many players there are -- unless
+    upstream is failing and the poller's backing off, when players' own
+    refreshes take over again. Pollers stop when the last
+    viewer of the variant leaves (see on_viewer_leave()), once nobody has
+    asked for it in idle_timeout seconds, or when the playlist ends.
+    """
+
+    def __init__(self, idle_timeout:float=POLL_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+
+        self._tasks = {}   # str(playlist) -> asyncio.Task
+        self._watched = {} # str(playlist) -> monotonic time of the last player request
+        self._playlists = {} # str(playlist) -> the Playlist being followed
+
+        self.polls = 0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def watch(self, stream:"Stream", playlist:"Playlist"):
+        """A player just asked for playlist -- keep (or start) following it."""
+        key = str(playlist)
+        self._watched[key] = time.monotonic()
+
+        task = self._tasks.get(key)
+        if (task is not None and self._playlists.get(key) is playlist) or playlist.final():
+            return
+
+        # the stream was replaced (expired session), follow the new one's copy
+        if task is not None:
+            task.cancel()
+
+        logger.info(f"starting playlist poller for {playlist}")
+        task = asyncio.ensure_future(self._poll(stream, playlist))
+        self._tasks[key] = task
+        self._playlists[key] = playlist
+        task.add_done_callback(lambda t: self._done(key, t))
+
+    def stop(self, key:str):
+        """Stop following str(playlist) == key, if we are."""
+        task = self._tasks.get(key)
+        if task is not None:
+            logger.info(f"stopping playlist poller for {key}, nobody's watching it")
+            task.cancel()
+
+    def forget(self, stream_id:str):
+        """Stop following every variant of stream_id."""
+        prefix = f"{stream_id}/"
+        for key, task in list(self._tasks.items()):
+            if key.startswith(prefix):
+                task.cancel()
+
+    def on_viewer_leave(self, event:"ViewerEvent"):
+        if event.variant is not None and not event.variant_viewers:
+            self.stop(f"{event.stream_id}/{event.variant}")
+
+    def _done(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+            self._watched.pop(key, None)
+            self._playlists.pop(key, None)
+        if not task.cancelled() and task.exception():
+            logger.error(f"playlist poller for {key} died: {task.exception()}")
+
+    async def _poll(self, stream:"Stream", playlist:"Playlist"):
+        key = str(playlist)
+        changed = True # the request that started us just fetched it
+        failures = 0
+        playlist.polled = True
+        try:
+            while True:
+                target = target_duration(playlist.media or b"") or DEFAULT_TARGET_DURATION
+                if failures:
+                    wait = target * min(MAX_FAILURE_BACKOFF, failures)
+                elif changed:
+                    wait = target
+                else:
+                    wait = target * UNCHANGED_FRACTION
+                await asyncio.sleep(wait)
+
+                idle = time.monotonic() - self._watched.get(key, 0.0)
+                if idle > self.idle_timeout:
+                    logger.info(f"stopping playlist poller for {playlist}, no viewers for {idle:.0f}s")
+                    return
+
+                try:
+                    changed = await playlist.refresh_media()
+                    if changed:
+                        # everyone watching this variant gets the same rewrite
+                        # with relative URIs, so usually this is just the one
+                        for own_base in list(playlist.rewriters):
+                            await rewrite_media_playlist(stream, playlist.name, own_base)
+                    self.polls += 1
+                    failures = 0
+                except Exception as err:
+                    self.failed += 1
+                    failures += 1
+                    logger.warning(f"playlist poll for {playlist} failed ({failures} in a row): {err}")
+
+                if playlist.final():
+                    logger.info(f"stopping playlist poller for {playlist}, playlist has ended")
+                    return
+        finally:
+            playlist.polled = False
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
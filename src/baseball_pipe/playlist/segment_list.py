@@ -0,0 +1,78 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
+class SegmentList():
+    """The real segments a rewrite kept, in playback order, without an object per segment.
+
+    Paths are packed into one newline-separated string, with their starting
+    offsets and durations in arrays alongside. A list of (path, duration)
+    tuples plus a path -> index dict costs a few hundred bytes a segment;
+    this is the path's own characters and 32 bytes. Looking a path up goes
+    through the paths' hashes, kept sorted in another array: a bisect, then
+    a compare against the packed path -- every segment request does one per
+    loaded variant, so it can't be a scan of the whole playlist.
+
+    append() only buffers -- the buffer is packed on the next read, so a
+    rewrite appending a whole VOD's worth of segments joins them once.
+    """
+
+    __slots__ = ("_paths", "_starts", "_hashes", "_order", "durations", "_pending")
+
+    def __init__(self):
+        self._paths = "\n"        # "\npath0\npath1\n...", every path between two newlines
+        self._starts = array("q") # offset of the newline in front of each path
+        self._hashes = array("q") # hash() of every path, sorted
+        self._order = array("q")  # index of the path each of _hashes is for
+        self.durations = array("d")
+        self._pending = []
+
+    def __len__(self):
+        return len(self.durations)
+
+    def nbytes(self) -> int:
+        """Bytes held in the packed paths and arrays."""
+        return (len(self._paths) + sum(len(path) + 1 for path in self._pending)
+                + self._starts.itemsize * len(self._starts)
+                + self._hashes.itemsize * len(self._hashes)
+                + self._order.itemsize * len(self._order)
+                + self.durations.itemsize * len(self.durations))
+
+    def append(self, path:str, duration:float):
+        self._pending.append(path)
+        self.durations.append(duration)
+
+    def _pack(self):
+        offset = len(self._paths) - 1
+        for path in self._pending:
+            # after any equal hash, so a path kept twice is found at its first index
+            hashed = hash(path)
+            at = bisect_right(self._hashes, hashed)
+            self._hashes.insert(at, hashed)
+            self._order.insert(at, len(self._starts))
+            self._starts.append(offset)
+            offset += len(path) + 1
+        self._paths += "\n".join(self._pending) + "\n"
+        self._pending = []
+
+    def path(self, index:int) -> str:
+        if self._pending:
+            self._pack()
+        start = self._starts[index] + 1
+        return self._paths[start:self._paths.index("\n", start)]
+
+    def index(self, path:str) -> int:
+        """Position of path in playback order, or None if the rewrite didn't keep it."""
+        if self._pending:
+            self._pack()
+        hashed = hash(path)
+        at = bisect_left(self._hashes, hashed)
+        while at < len(self._hashes) and self._hashes[at] == hashed:
+            if self.path(self._order[at]) == path:
+                return self._order[at]
+            at += 1
+        return None
+
+    def items(self, start:int, stop:int):
+        """(path, duration) for segments start:stop."""
+        for i in range(max(0, start), min(stop, len(self))):
+            yield self.path(i), self.durations[i]
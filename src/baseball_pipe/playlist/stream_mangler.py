@@ -1,21 +1,65 @@
+import asyncio
+import math
 import os
 import re
 import time
-from datetime import datetime, timedelta
+from array import array
+from collections import OrderedDict, deque
+from bisect import bisect_left, bisect_right
+from datetime import datetime
 from urllib.parse import urljoin
 
 import logging
 
 from baseball_pipe.mlbtv.stream import Stream
-from baseball_pipe.mlbtv.media_playlist import Playlist
+from baseball_pipe.mlbtv.media_playlist import Playlist, SPLIT_RES, NTSC_FPS, FILLER_DURATION
+from baseball_pipe.mlbtv.playlist_cache import target_duration
 from baseball_pipe.playlist import generate_filler_segments as gfs
+from baseball_pipe.playlist.timeline import SegmentTimeline, FINGERPRINT_LENGTH, MICROS, media_sequence, to_micros, parse_program_date_time
+from baseball_pipe.playlist.ad_breaks import AdBreak, AdBreakMap, MATCH_TOLERANCE
+from baseball_pipe.playlist.segment_list import SegmentList
 
 logger = logging.getLogger(__name__)
 
 URI_PATTERN = re.compile(r'URI="([^"]+)"')
+URI_BYTES_PATTERN = re.compile(rb'URI="([^"]+)"')
 PLAYLIST_TYPE_PATTERN = re.compile("#EXT-X-PLAYLIST-TYPE:([A-Z]+)")
 CUE_OUT_CONT_PATTERN = re.compile(r'ElapsedTime=([\d.]+),Duration=([\d.]+)')
 AUTOSELECT_PATTERN = re.compile(r'AUTOSELECT=YES')
+# one segment of rewritten output: its EXTINF through its URI line
+OUTPUT_SEGMENT_PATTERN = re.compile(rb'#EXTINF:([^,\n]*)[^\n]*\n(?:#[^\n]*\n)*[^#\n][^\n]*')
+
+SEGMENT_EXTENSIONS = (b".ts", b".aac", b".vtt")
+
+# tags the rewriter dispatches on -- media playlists are rewritten as bytes
+ENDLIST = b"#EXT-X-ENDLIST"
+PROGRAM_DATE_TIME = b"#EXT-X-PROGRAM-DATE-TIME"
+EXTINF = b"#EXTINF"
+CUE_OUT = b"#EXT-X-CUE-OUT"
+CUE_IN = b"#EXT-X-CUE-IN"
+DISCONTINUITY = b"#EXT-X-DISCONTINUITY"
+TARGET_DURATION = b"#EXT-X-TARGETDURATION"
+SERVER_CONTROL = b"#EXT-X-SERVER-CONTROL"
+VERSION = b"#EXT-X-VERSION"
+KEY = b"#EXT-X-KEY"
+SKIP = b"#EXT-X-SKIP"
+PLAYLIST_TYPE = b"#EXT-X-PLAYLIST-TYPE"
+MEDIA_SEQUENCE = b"#EXT-X-MEDIA-SEQUENCE"
+DISCONTINUITY_SEQUENCE = b"#EXT-X-DISCONTINUITY-SEQUENCE"
+START = b"#EXT-X-START"
+HASH = ord("#")
+
+# what PlaylistRewriter does with ad breaks, see its docstring
+FILLER = "filler"
+STRIP = "strip"
+PASSTHROUGH = "passthrough"
+AD_POLICIES = (FILLER, STRIP, PASSTHROUGH)
+AD_POLICY = os.environ.get("bbp_ad_policy", FILLER)
+
+# where the stream clock sits relative to the game's start/end trim
+BEFORE_START = -1
+IN_GAME = 0
+AFTER_END = 1
 
 # real MLB ad segments run at their own upstream cadence (1-6s each), but the
 # filler library is a fixed 1-second-per-file countdown (see
@@ -23,6 +67,53 @@ AUTOSELECT_PATTERN = re.compile(r'AUTOSELECT=YES')
 # duration, used so EXTINF stays accurate for the substituted content
 FILLER_SEGMENT_DURATION = 1.001
 
+# built filler breaks kept around, see all_filler_no_killer() -- a game has
+# a couple dozen distinct break lengths per rendition at most
+FILLER_BLOCK_CACHE_SIZE = int(os.environ.get("bbp_filler_block_cache", 256))
+_FILLER_BLOCKS = OrderedDict() # (resolution, frame rate, filler duration, segments, own_base) -> (tuple of lines, joined bytes)
+
+# a streamed rewrite (see RewriteChunks) buffers at most this much for a
+# player that's fallen behind -- it gets the rest from the finished output
+# instead, in slices this big
+STREAM_BUFFER_BYTES = 256 * 1024
+STREAM_SLICE_BYTES = 64 * 1024
+
+# LL-HLS blocking playlist reload: a player can ask for the playlist once
+# it has a given media sequence number (?_HLS_msn=) and we hold the request
+# until it does, instead of it polling on a timer and getting the same
+# playlist back
+BLOCKING_RELOAD = os.environ.get("bbp_blocking_reload", "1") != "0"
+# how many target durations a blocked reload waits before giving up (503)
+BLOCKING_RELOAD_TARGETS = 3
+# until a playlist says otherwise
+DEFAULT_TARGET_DURATION = 6.0
+
+# playlist delta updates: a player that asks with ?_HLS_skip=YES gets the
+# segments older than CAN-SKIP-UNTIL replaced by one EXT-X-SKIP tag, since it
+# has them already -- so a late-game poll costs the last few segments, not
+# the whole game so far
+DELTA_UPDATES = os.environ.get("bbp_delta_updates", "1") != "0"
+# CAN-SKIP-UNTIL, in target durations -- the spec's minimum
+SKIP_UNTIL_TARGETS = 6
+# EXT-X-SKIP needs a playlist of at least this version
+SKIP_VERSION = 9
+
+# live window mode: players that opt in (see media_handler) get only the
+# last few minutes of a live game, as a sliding-window LIVE playlist
+LIVE_WINDOW = "live_window"
+LIVE_WINDOW_MINUTES = float(os.environ.get("bbp_live_window_minutes", 5))
+
+# where a player should join a live game: HOLD-BACK (in SERVER-CONTROL) and
+# an EXT-X-START that far from the live edge, nudged off any ad break so it
+# doesn't join on filler it's only going to sit through
+START_OFFSET = os.environ.get("bbp_start_offset", "1") != "0"
+# in target durations -- the spec's minimum for both
+HOLD_BACK_TARGETS = max(3.0, float(os.environ.get("bbp_hold_back_targets", 3)))
+MIN_START_TARGETS = 3
+# TIME-OFFSET lands this far (seconds) into the segment it's meant for, so
+# rounding can't tip it into the one before
+START_SLACK = 0.1
+
 def uri_search_and_replace(line, full_url):
     logger.debug(f"rewriting URL for line {line}")
     old = URI_PATTERN.search(line)
@@ -34,12 +125,13 @@ def uri_search_and_replace(line, full_url):
 def force_autoselect_no(line):
     return AUTOSELECT_PATTERN.sub("AUTOSELECT=NO", line)
 
-def format_program_date_time(dt:datetime) -> str:
-    ms = dt.microsecond // 1000
-    ts_str = dt.strftime("%Y-%m-%dT%H:%M:%S") + f".{ms:03d}Z"
+def format_program_date_time(micros:int) -> str:
+    seconds, micros = divmod(micros, MICROS)
+    ts_str = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds)) + f".{micros // 1000:03d}Z"
     return f"#EXT-X-PROGRAM-DATE-TIME:{ts_str}"
 
-def prefix_master_urls(playlist, base_url):
+def prefix_master_urls(playlist, base_url, query=None):
+    # query (e.g. "live_window=5") is passed on to every media playlist
     lines = []
     for line in playlist.splitlines():
         
@@ -51,489 +143,1099 @@ def prefix_master_urls(playlist, base_url):
             line = uri_search_and_replace(line, base_url)
             if line.startswith("#EXT-X-MEDIA:") and "TYPE=SUBTITLES" in line:
                 line = force_autoselect_no(line) # forced subtitles are annoying as fuck
+            if query and line.startswith(("#EXT-X-MEDIA:", "#EXT-X-I-FRAME-STREAM-INF:")):
+                line = URI_PATTERN.sub(lambda match: f'URI="{add_query(match.group(1), query)}"', line)
             lines.append(line)
         elif line.startswith("#"): #NOT A URL
             lines.append(line)
         else: #RELATIVE URL
-            lines.append(urljoin(base_url, line.strip()))
+            url = urljoin(base_url, line.strip())
+            lines.append(add_query(url, query) if query else url)
 
     return "\n".join(lines)
 
-async def rewrite_media_playlist(stream:Stream, name:str, own_base:str):
+def add_query(url, query):
+    return f"{url}{'&' if '?' in url else '?'}{query}"
+
+async def rewrite_media_playlist(stream:Stream, name:str, own_base:str, chunked:bool=False, skip:bool=False, window:float=None):
+    """The rewritten media playlist as bytes.
 
-    playlist:Playlist = stream.get_variant(name)
+    With chunked=True, a rewrite that has to start from scratch (the first
+    request for a finished game, say) comes back as an async iterator of
+    byte chunks instead, produced as the rewrite goes -- anything already
+    rewritten still comes back as bytes. With skip=True it's the playlist's
+    delta update instead, see PlaylistRewriter.delta(), and with a window
+    (seconds) just the live edge, see PlaylistRewriter.live_window().
+    """
+    playlist:Playlist = await stream.get_variant(name)
     assert playlist, f"unknown playlist {name} for stream {stream}"
 
     playlist_media = await playlist.get_media()
-    lines = playlist_media.split('\n')
 
     if not stream.get_playlist_type():
-        stream.set_playlist_type(determine_playlist_type(lines))
-
-    if stream.get_playlist_type() == "vod":
-        return await rewrite_live_playlist2(stream,
-                                        playlist,
-                                        lines,
-                                        own_base,
-                                        ad_free=ad_free,
-                                        strip=strip,
-                                        start_time=await stream.get_start(),
-                                        end_time=await stream.get_end())
-    else:
-        return await rewrite_live_playlist2(stream,
-                                        playlist,
-                                        lines,
-                                        own_base,
-                                        ad_free=ad_free,
-                                        strip=strip,
-                                        start_time=await stream.get_start(),
-                                        end_time=await stream.get_end())
-        
+        stream.set_playlist_type(determine_playlist_type(playlist_media.split(b'\n', 10)))
+
+    start_time = await stream.get_start()
+    end_time = await stream.get_end()
+
+    # a streamed rewrite hands control back to the event loop between
+    # chunks, nobody else touches this variant's rewriters until it's done
+    # (see RewriteChunks, which releases the lock once it is)
+    await playlist.rewrite_lock.acquire()
+    try:
+        known_segments = len(playlist.segments)
+
+        # vod and live go through the same rewriter -- a finished game is just
+        # a live one that's already reached its ENDLIST
+        rewriter:PlaylistRewriter = playlist.rewriters.get(own_base)
+        if rewriter is None or not rewriter.continues(playlist_media, start_time, end_time):
+            rewriter = PlaylistRewriter(own_base,
+                                        policy=ad_policy(playlist),
+                                        start_time=start_time,
+                                        end_time=end_time,
+                                        resolution=playlist.mdict.get(SPLIT_RES),
+                                        frame_rate=playlist.mdict.get(NTSC_FPS),
+                                        filler_duration=playlist.mdict.get(FILLER_DURATION),
+                                        ad_breaks=stream.ad_breaks)
+            playlist.rewriters[own_base] = rewriter
+
+        timeline = playlist.get_timeline(playlist_media)
+        stream.ad_breaks.update(playlist_media, timeline)
+
+        if chunked and not skip and not window and rewriter.fresh(playlist_media):
+            chunks = rewriter.feed_chunks(playlist_media, name=str(playlist), timeline=timeline)
+            return RewriteChunks(stream, playlist, rewriter, chunks, known_segments)
+
+        rewritten = rewriter.feed(playlist_media, name=str(playlist), timeline=timeline)
+        _rewrote(stream, playlist, rewriter, known_segments)
+        if window:
+            rewritten = rewriter.live_window(window)
+        elif skip:
+            rewritten = rewriter.delta()
+    except BaseException:
+        playlist.rewrite_lock.release()
+        raise
+
+    playlist.rewrite_lock.release()
+    return rewritten
+
+async def rewrite_media_playlist_at(stream:Stream, name:str, own_base:str, msn:int, skip:bool=False, window:float=None) -> bytes:
+    """rewrite_media_playlist(), once the rewritten playlist has media sequence number msn in it.
+
+    Serves a blocking playlist reload. Upstream isn't low latency and has no
+    partial segments, so this waits for msn as a whole segment. Returns None
+    if it hasn't shown up after BLOCKING_RELOAD_TARGETS target durations.
+    Raises ValueError if msn is more than two segments past the live edge,
+    which the spec says is an error rather than a wait.
+    """
+    playlist:Playlist = await stream.get_variant(name)
+    assert playlist, f"unknown playlist {name} for stream {stream}"
+
+    deadline = None
+    while True:
+        rewritten = await rewrite_media_playlist(stream, name, own_base, skip=skip, window=window)
+        rewriter:PlaylistRewriter = playlist.rewriters[own_base]
+
+        # a finished playlist is never getting msn, hand it back as is
+        last = rewriter.last_media_sequence()
+        if msn <= last or rewriter.ended or ENDLIST in rewritten[-64:]:
+            return rewritten
+        if msn > last + 2:
+            raise ValueError(f"_HLS_msn={msn} is too far past the last media sequence number ({last}) of {playlist}")
+
+        now = time.monotonic()
+        if deadline is None:
+            target = target_duration(playlist.media) or DEFAULT_TARGET_DURATION
+            deadline = now + BLOCKING_RELOAD_TARGETS * target
+        if now >= deadline:
+            logger.info(f"gave up waiting for media sequence {msn} of {playlist}, last is {last}")
+            return None
+
+        await playlist.wait_for_media(deadline - now)
+
+class RewriteChunks():
+    """Async iterator over a streamed rewrite's byte chunks.
+
+    The rewrite runs in its own task, holding the playlist's rewrite_lock
+    (taken in rewrite_media_playlist()) only until the rewriter has been
+    fed to the end -- never while a chunk is on its way to the player, so
+    a slow or stalled client can't hold up other players, the poller or
+    blocked reloads. The task yields to the event loop between pieces, so
+    the first chunk can go out while the rest is still being rewritten.
+
+    Chunks the player hasn't read yet wait in a buffer of at most
+    STREAM_BUFFER_BYTES. Once a player falls further behind than that the
+    buffer stops taking chunks, and the rest is sliced out of the finished
+    output (which the rewriter keeps anyway) instead of copied.
+    """
+
+    def __init__(self, stream:Stream, playlist:Playlist, rewriter:"PlaylistRewriter", chunks, known_segments:int):
+        self.stream = stream
+        self.playlist = playlist
+        self.rewriter = rewriter
+        self._chunks = chunks
+        self._known_segments = known_segments
+        self.closed = False
+
+        self._buffer = deque()
+        self._buffered = 0    # bytes in _buffer
+        self._offset = 0      # bytes of the output that have gone into _buffer
+        self._behind = False  # the player fell behind, the rest comes from _output
+        self._output = None   # the finished output, once it is
+        self._ready = asyncio.Event()
+        self._finished = False
+        self._error = None
+        self._task = asyncio.ensure_future(self._run())
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        while not self._buffer:
+            if self.closed:
+                raise StopAsyncIteration
+            if self._finished:
+                if self._error is not None:
+                    raise self._error
+                if self._behind and self._offset < len(self._output):
+                    chunk = self._output[self._offset:self._offset + STREAM_SLICE_BYTES]
+                    self._offset += len(chunk)
+                    return chunk
+                raise StopAsyncIteration
+            self._ready.clear()
+            await self._ready.wait()
+
+        chunk = self._buffer.popleft()
+        self._buffered -= len(chunk)
+        return chunk
+
+    def _put(self, chunk:bytes):
+        if self.closed or self._behind:
+            return
+        if self._buffer and self._buffered + len(chunk) > STREAM_BUFFER_BYTES:
+            self._behind = True
+            return
+        self._buffer.append(chunk)
+        self._buffered += len(chunk)
+        self._offset += len(chunk)
+        self._ready.set()
+
+    async def _run(self):
+        try:
+            for chunk in self._chunks:
+                self._put(chunk)
+                await asyncio.sleep(0)
+        except Exception as err:
+            self._error = err
+        finally:
+            try:
+                # cancelled halfway -- the rewriter can't be left half fed
+                for _ in self._chunks:
+                    pass
+                if self._error is None:
+                    _rewrote(self.stream, self.playlist, self.rewriter, self._known_segments)
+                    # the chunks add up to this, so it carries on where they stopped
+                    self._output = self.rewriter.output()
+            except Exception as err:
+                self._error = self._error or err
+            finally:
+                self.playlist.rewrite_lock.release()
+                self._finished = True
+                self._ready.set()
+
+    def close(self):
+        """Stop buffering chunks -- the rewrite itself carries on to the end."""
+        self.closed = True
+        self._buffer.clear()
+        self._buffered = 0
+        self._ready.set()
+
+def _rewrote(stream:Stream, playlist:Playlist, rewriter:"PlaylistRewriter", known_segments:int):
+    playlist.set_segments(rewriter.segments)
+
+    if stream.prefetcher:
+        stream.prefetcher.on_playlist(stream, playlist, len(playlist.segments) - known_segments)
+
+def ad_policy(playlist:Playlist) -> str:
+    # filler only exists for video renditions, audio and subtitles just lose the break
+    if AD_POLICY == FILLER and playlist.mdict.get(SPLIT_RES) is None:
+        return STRIP
+    return AD_POLICY
+
 def determine_playlist_type(lines):
     max_lines_read = 10
     for i, line in enumerate(lines):
         if i == max_lines_read:
             raise Exception(f"media playlist doesnt have playlist type in first {max_lines_read} lines")
         
-        if line.startswith("#EXT-X-PLAYLIST-TYPE:"):
-            if "VOD" in line:
+        if line.startswith(b"#EXT-X-PLAYLIST-TYPE:"):
+            if b"VOD" in line:
                 return "vod"
             else:
                 return "live"
 
             
-async def nuke_playlist_ads(stream:Stream, name:str, lines:list, base_url:str):
-    func_start = time.perf_counter()
-    rewritten = [] # rewritten playlist
-    cued_out = False # in ad break
-    stream_time = None # moving playlist timestamp
-    started_segments = False # have we started writing segments yet
-
-    end_time = await stream.get_end()
-    start_time = await stream.get_start()
-
-    def can_write():
-        return (not cued_out
-                and (not start_time or stream_time >= start_time)
-                and (not end_time or stream_time <= end_time))
-
-    for line in lines:
-
-        #EMPTY
-        if not line:
-            continue
-
-        #ENDLIST
-        elif line.startswith("#EXT-X-ENDLIST"):
-                    rewritten.append(line)
-
-        #DATE TIME
-        elif line.startswith("#EXT-X-PROGRAM-DATE-TIME:"):
-            ts = line.split(":", 1)[1]
-            stream_time = datetime.fromisoformat(ts.replace("Z", "+00:00"))
-
-            if can_write():
-                rewritten.append(line)
-
-        # EXTINF
-        elif line.startswith("#EXTINF:"):
-
-            duration = float(line[len("#EXTINF:"):].split(",")[0])
-            segment_start_time = stream_time
-
-            if stream_time is not None:
-                stream_time = stream_time + timedelta(seconds=duration)
-
-            if can_write():
-
-                if not started_segments and segment_start_time is not None:
-                    started_segments = True
-                    last_line = rewritten[-1] if rewritten else None
-                    if not (last_line and last_line.startswith("#EXT-X-PROGRAM-DATE-TIME:")):
-                        rewritten.append(format_program_date_time(segment_start_time))
-
-                rewritten.append(line)
-
-        # TIME CHECK
-        elif start_time and stream_time and stream_time < start_time:
-            continue
-        
-        elif end_time and stream_time and stream_time > end_time:
-            rewritten.append("#EXT-X-ENDLIST")
-            break
-
-        # AD CUES
-        elif line.startswith("#EXT-X-CUE-IN"):
-            if not cued_out:
-                logger.warning(f"received unexpected #EXT-X-CUE-IN for {stream}{name}")
-
-            cued_out = False
-            rewritten.append("#EXT-X-DISCONTINUITY") # throw one of these bad boys in there
-
-        elif line.startswith("#EXT-X-CUE-OUT:"):
-            if cued_out:
-                logger.warning(f"received unexpected #EXT-X-CUE-OUT for {stream}{name}")
-
-            cued_out = True
-
-        elif cued_out:
-            continue
-
-        # SEGMENTS
-        elif line.endswith(".ts") or line.endswith(".aac") or line.endswith(".vtt"):
-            rewritten.append(base_url + line)
-
-        elif not line.startswith('#'):
-            rewritten.append(base_url + line)
-            logger.warning(f"unknown segment: {line} for {stream}{name}")
-
-        elif "URI=" in line:
-            rewritten.append(uri_search_and_replace(line, base_url))
-
-        # MISC
-
-        elif (line.startswith("#EXTM3U")
-                or line.startswith("#EXTINF:")
-                or line.startswith("#EXT-X-VERSION:")
-                or line.startswith("#EXT-X-TARGETDURATION:")
-                or line.startswith("#EXT-X-MEDIA-SEQUENCE:")
-                or line.startswith("#EXT-X-PROGRAM-DATE-TIME")
-                or line.startswith("#EXT-X-PLAYLIST-TYPE:")):
-            
-            rewritten.append(line)
+class HandlerTable(dict):
+    """Tag -> handler map for PlaylistRewriter, with a fallback for tags it doesn't list."""
+
+    def __init__(self, default, handlers:dict):
+        super().__init__(handlers)
+        self.default = default
+
+    def __missing__(self, tag):
+        return self.default
+
+class PlaylistRewriter():
+    """Single-pass rewrite of one variant's upstream media playlist.
+
+    Works on the upstream bytes as fetched -- nothing is decoded on the way
+    in or encoded on the way out. Every line is dispatched on its tag
+    (everything before the first ':', or b"" for a segment URI) through a
+    handler table. Which table is
+    live depends on where the stream clock is -- before first pitch, in the
+    game, inside an ad break, past the last out -- so each handler only
+    deals with its own tag instead of every line walking a startswith chain.
+    Handlers return None, one line, or a list of lines (a line may also be a
+    whole prebuilt block, like a filler break).
+
+    The ad policy decides what happens to ad breaks:
+        filler      - drop the ad segments and splice in countdown filler
+        strip       - drop the ad segments, leave a discontinuity behind
+        passthrough - leave the ads (and their cue tags) alone
+
+    A live game's upstream playlist is an EVENT playlist -- it only ever
+    grows at the end, so as long as the media sequence hasn't moved and the
+    text we already rewrote is still a prefix of the new copy, feed() only
+    runs the appended tail through the tables. Anything else needs a new
+    rewriter.
+    """
 
-        # GARBAGE
-        elif (line.startswith("#EXT-X-CUE-OUT-CONT:")
-                or line.startswith("#EXT-OATCLS-SCTE35")):
+    def __init__(self,
+                 own_base:str,
+                 policy:str=FILLER,
+                 start_time:datetime=None,
+                 end_time:datetime=None,
+                 resolution:tuple=None,
+                 frame_rate:str=None,
+                 filler_duration:float=None,
+                 ad_breaks:AdBreakMap=None):
+
+        if policy not in AD_POLICIES:
+            raise ValueError(f"invalid ad policy: {policy}")
+
+        self.own_base = own_base
+        self._own_base = own_base.encode()
+        self.policy = policy
+        self.start_time = start_time
+        self.end_time = end_time
+        self._start = to_micros(start_time)
+        self._end = to_micros(end_time)
+        self.resolution = resolution
+        self.frame_rate = frame_rate
+        self.filler_duration = filler_duration
+        # the stream's ad breaks, shared with its other variants
+        self.ad_breaks = ad_breaks
+
+        if policy == FILLER and not (resolution and frame_rate and filler_duration):
+            raise ValueError("filler ad policy needs a video rendition")
+
+        # upstream text already consumed, checked against the next copy
+        self.media_sequence = None
+        self.offset = 0
+        self.fingerprint = b""
+
+        # rewritten output so far, plus provisional filler for an open ad break,
+        # and the two joined for serving (rebuilt only when either changes) --
+        # once the playlist's ended only the joined copy is kept
+        self.body = bytearray()
+        self.tail = b""
+        self._output = b""
+
+        # EXTINFs in body and tail, for the output's media sequence numbers
+        self.body_segments = 0
+        self.tail_segments = 0
+
+        # where each segment in body ends, and how far into the output (in
+        # seconds) it is by then -- only built once a delta update needs it
+        self.segment_ends = array("q")
+        self.segment_elapsed = array("d")
+        self._indexed = 0 # body offset the segment index has reached
+
+        # whether the playlist was still live when its header went through,
+        # i.e. whether it gets a SERVER-CONTROL line, see _on_target_duration()
+        self.live = True
+
+        # CAN-SKIP-UNTIL we advertised, and the delta update last built
+        self.skip_until = None
+        # delta updates and live windows, see _view()
+        self._views = {} # view -> ((body length, tail, start tag), bytes)
+
+        # EXT-X-START for the live edge as of the last feed, spliced in after
+        # the SERVER-CONTROL line rather than kept in body, since it moves
+        self.target_duration = None
+        self.start_tag = b""
+        self._start_tag_at = None
+
+        # stream clock (epoch microseconds) and ad bookkeeping, carried over between refreshes
+        self.stream_time = None
+        self.window = IN_GAME
+        self.cued_out = False
+        self.ended = False
+        self.started_segments = False
+        self.program_date_time_kept = False
+        self.duration = 0.0
+        self.ad_start = None
+        self.ad_elapsed = 0.0
+        self.expected_ad_duration = 0.0
+
+        # (path, duration) of every real segment kept, for the prefetcher
+        self.segments = SegmentList()
+
+        self.extinf_count = 0
+        self.segment_count = 0
+
+        self._build_tables()
+
+    def _build_tables(self):
+        keep, drop = self._keep, self._drop
+        ads = self.policy != PASSTHROUGH
+
+        clock = {
+            ENDLIST: keep,
+            PROGRAM_DATE_TIME: self._on_program_date_time,
+            EXTINF: self._on_extinf,
+        }
+
+        self._normal = HandlerTable(self._on_other_tag, {
+            **clock,
+            b"": self._on_segment,
+            b"#EXTM3U": keep,
+            VERSION: keep,
+            TARGET_DURATION: self._on_target_duration,
+            SERVER_CONTROL: drop, # upstream's, we write our own
+            MEDIA_SEQUENCE: keep,
+            PLAYLIST_TYPE: keep,
+            DISCONTINUITY: keep,
+            DISCONTINUITY_SEQUENCE: keep,
+            CUE_OUT: self._on_cue_out if ads else keep,
+            CUE_IN: self._on_cue_in if ads else keep,
+            b"#EXT-X-CUE-OUT-CONT": drop if ads else keep,
+            b"#EXT-OATCLS-SCTE35": drop if ads else keep,
+        })
+
+        # mid-break only the clock and the cues matter, the ad itself is dropped
+        self._cued = HandlerTable(drop, {
+            **clock,
+            CUE_OUT: self._on_cue_out,
+            CUE_IN: self._on_cue_in,
+        })
+
+        self._before_start = HandlerTable(drop, clock)
+        self._after_end = HandlerTable(self._on_end, clock)
+        self._ended = HandlerTable(drop, {})
+
+        self._select_table()
+
+    def _select_table(self):
+        if self.ended:
+            self._table = self._ended
+        elif self.window == BEFORE_START:
+            self._table = self._before_start
+        elif self.window == AFTER_END:
+            self._table = self._after_end
+        elif self.cued_out:
+            self._table = self._cued
+        else:
+            self._table = self._normal
+
+    def _tick(self):
+        # re-place the stream clock against the game window after it moves
+        stream_time = self.stream_time
+        if self._start is not None and stream_time < self._start:
+            window = BEFORE_START
+        elif self._end is not None and stream_time > self._end:
+            window = AFTER_END
+        else:
+            window = IN_GAME
+
+        if window != self.window:
+            self.window = window
+            self._select_table()
+
+    # INCREMENTAL
+    def nbytes(self) -> int:
+        """Bytes of output (and its indexes and views) this rewriter is holding on to."""
+        return (len(self.body) + len(self.tail) + len(self._output)
+                + sum(len(view) for _, view in self._views.values())
+                + self.segment_ends.itemsize * len(self.segment_ends)
+                + self.segment_elapsed.itemsize * len(self.segment_elapsed)
+                + self.segments.nbytes())
+
+    def continues(self, media:bytes, start_time:datetime, end_time:datetime) -> bool:
+        return (self.start_time == start_time
+                and self.end_time == end_time
+                and len(media) >= self.offset
+                and media.startswith(self.fingerprint, self.offset - len(self.fingerprint))
+                and media_sequence(media) == self.media_sequence)
+
+    def feed(self, media:bytes, name:str="", timeline:SegmentTimeline=None) -> bytes:
+        """Rewrite whatever's new in this copy of the upstream playlist, returning the whole output.
+
+        Given the playlist's timeline, a first pass skips straight to the
+        segments around first pitch and stops just past the last out instead
+        of running the pre/postgame through the tables line by line.
+        """
+        for _ in self.feed_chunks(media, name, timeline):
             pass
-
-        # CATCHALL
+        return self._output
+
+    def output(self) -> bytes:
+        """The whole output as of the last feed."""
+        return self._output
+
+    def fresh(self, media:bytes) -> bool:
+        """True if feeding media would rewrite from scratch, i.e. feed_chunks() is worth streaming."""
+        return not self.body and not self.ended and len(media) != self.offset
+
+    def feed_chunks(self, media:bytes, name:str="", timeline:SegmentTimeline=None):
+        """feed(), yielding the output as it's written instead of returning it at the end.
+
+        On a fresh rewriter the chunks are the whole playlist, one per piece
+        of upstream, so it can go out to the player while the rest is still
+        being rewritten. Otherwise it's the whole output as one chunk. Must
+        be run to the end either way -- the rewriter has already moved past
+        the new upstream text once the first chunk comes out.
+        """
+        if self.media_sequence is None:
+            self.media_sequence = media_sequence(media)
+
+        if self.ended or len(media) == self.offset:
+            logger.debug(f"no new lines in {name}, reusing rewritten playlist")
+            yield self._output
+            return
+
+        func_start = time.perf_counter()
+        streaming = not self.body
+        if streaming:
+            self.live = not self._final(media, timeline)
+        if self.target_duration is None:
+            self.target_duration = target_duration(media)
+        self.start_tag = self._start_tag(media, timeline) if START_OFFSET else b""
+        if self.offset == 0 and timeline is not None and timeline.timed and len(timeline):
+            pieces = self._cut(media, timeline)
         else:
-            logger.warning(f"keeping unknown line: {line} for {stream}{name}")
-            rewritten.append(line)
-
-    elapsed_ms = (time.perf_counter() - func_start) * 1000
-    logger.info(f"rewrote vod playlist in {elapsed_ms:.2f}ms, {len(lines)} lines reduced to {len(rewritten)}")
-    return '\n'.join(rewritten)
-
-
-async def rewrite_vod_playlist3(stream:Stream, playlist:str, lines:list, own_base:str, ad_free=True, strip=True, start_time:datetime=None, end_time:datetime=None):
-
-    func_start = time.perf_counter()
-    rewritten = []
-    cued_out = False
-    stream_time = None
-    extinf_count = 0
-    segment_count = 0
-    started_segments = False
-
-
-    for line in lines:
-
-        if not line:
-            continue
-
-        elif line.startswith("#EXT-X-ENDLIST"):
-            rewritten.append(line)
-
-        elif line.startswith("#EXT-X-PROGRAM-DATE-TIME:"):
-            if strip:
-                ts = line.split(":", 1)[1]
-                stream_time = datetime.fromisoformat(ts.replace("Z", "+00:00"))
-
-            if (not cued_out
-                    and (not start_time or stream_time >= start_time)
-                    and (not end_time or stream_time <= end_time)):
-                rewritten.append(line)
-
-        elif line.startswith("#EXTINF:"):
-            segment_start_time = None
-            if strip:
-                duration = float(line[len("#EXTINF:"):].split(",")[0])
-                segment_start_time = stream_time
-                if stream_time is not None:
-                    stream_time = stream_time + timedelta(seconds=duration)
-
-            if (not cued_out
-                    and (not start_time or stream_time >= start_time)
-                    and (not end_time or stream_time <= end_time)):
-
-                if not started_segments and segment_start_time is not None:
-                    last_line = rewritten[-1] if rewritten else None
-                    if not (last_line and last_line.startswith("#EXT-X-PROGRAM-DATE-TIME:")):
-                        rewritten.append(format_program_date_time(segment_start_time))
-
-                rewritten.append(line)
-                extinf_count += 1
-                started_segments = True
-
-        elif start_time and stream_time and stream_time < start_time:
-            continue
-
-        elif end_time and stream_time and stream_time > end_time:
-            rewritten.append("#EXT-X-ENDLIST")
-            break
-
-        elif line.startswith("#EXT-X-CUE-IN"):
-            if ad_free:
-                if not cued_out:
-                    logger.warning("received unexpected #EXT-X-CUE-IN")
-
-                cued_out = False
-                rewritten.append("#EXT-X-DISCONTINUITY") # throw one of these bad boys in there
-
+            pieces = [(None, self.offset, len(media), None)]
+        if self.ad_breaks is not None and timeline is not None and self.policy != PASSTHROUGH:
+            pieces = self._splice_breaks(media, timeline, pieces)
+        self.offset = len(media)
+        self.fingerprint = media[-FINGERPRINT_LENGTH:]
+
+        # each piece goes straight onto the end of body, so only one piece's
+        # worth of lines is ever alive at a time
+        body = self.body
+        added = 0
+        line_count = 0
+        for clock, start, stop, ad_break in pieces:
+            if clock is not None:
+                self.stream_time = clock
+                self._tick()
+            if ad_break is not None and self._can_splice(ad_break):
+                out = self._splice(ad_break)
             else:
-                rewritten.append(line)
-
-        elif line.startswith("#EXT-X-CUE-OUT:"):
-            if ad_free:
-                if cued_out:
-                    logger.warning("received unexpected #EXT-X-CUE-OUT")
-                cued_out = True
-
+                lines = media[start:stop].split(b'\n')
+                line_count += len(lines)
+                out = list(self.rewrite(lines))
+            if out:
+                chunk = b'\n'.join(out)
+                first_chunk = not body
+                if not first_chunk:
+                    chunk = b'\n' + chunk
+                body += chunk
+                self.body_segments += chunk.count(EXTINF)
+                added += len(out)
+                if streaming:
+                    # the header's in the first chunk
+                    yield self._with_start_tag(chunk) if first_chunk else chunk
+
+        # an ad break still open at the live edge gets filler up to where
+        # upstream is now, but that's provisional -- it's redone from the
+        # carried-over ad_elapsed on the next refresh rather than kept
+        pending = self.pending_filler()
+        self.tail = b'\n' + pending if pending else b""
+        self.tail_segments = self.tail.count(EXTINF)
+        if ENDLIST in body[-64:]:
+            self.ended = True
+        if self.ended:
+            self.start_tag = b""
+            if not streaming:
+                # it was live when the header went out, there's nothing
+                # left to block on or skip now (a playlist that started
+                # out final never had the line)
+                self._drop_server_control()
+        self._output = self._with_start_tag(body, self.tail)
+        if self.ended:
+            self._drop_body()
+
+        elapsed_ms = (time.perf_counter() - func_start) * 1000
+        logger.info(f"rewrote {line_count} new lines of {name} in {elapsed_ms:.2f}ms. {self.segment_count} segments, {self.extinf_count} EXTINF lines, {added} lines added")
+
+        if not streaming:
+            yield self._output
+        elif self.tail:
+            yield self.tail
+
+    def _final(self, media:bytes, timeline:SegmentTimeline) -> bool:
+        """True if media is already the whole playlist: a VOD, ended upstream, or past the end trim."""
+        if ENDLIST in media[-64:] or PLAYLIST_TYPE + b":VOD" in media[:1024]:
+            return True
+        return (self._end is not None and timeline is not None and timeline.timed
+                and len(timeline) > 0 and timeline.start[-1] > self._end)
+
+    def _drop_server_control(self):
+        control = self.body.find(SERVER_CONTROL)
+        if control != -1:
+            del self.body[control:self.body.find(b"\n", control) + 1]
+
+    def _drop_body(self):
+        # nothing more is getting appended, and nothing but the whole output
+        # is served from an ended playlist -- keep that, not a second copy
+        self.body = bytearray()
+        self.segment_ends = array("q")
+        self.segment_elapsed = array("d")
+        self._indexed = 0
+        self._views.clear()
+
+    def _index_segments(self):
+        body = self.body
+        elapsed = self.segment_elapsed[-1] if self.segment_elapsed else 0.0
+        for match in OUTPUT_SEGMENT_PATTERN.finditer(body, self._indexed):
+            elapsed += float(match.group(1))
+            self.segment_ends.append(match.end())
+            self.segment_elapsed.append(elapsed)
+        if self.segment_ends:
+            self._indexed = self.segment_ends[-1]
+
+    def last_media_sequence(self) -> int:
+        """Media sequence number of the last segment in the output.
+
+        The output keeps upstream's #EXT-X-MEDIA-SEQUENCE, but after trimming
+        and splicing its segments no longer line up with upstream's, so this
+        counts the output's own.
+        """
+        return (self.media_sequence or 0) + self.body_segments + self.tail_segments - 1
+
+    def delta(self) -> bytes:
+        """The output as a playlist delta update, or the whole output if there's nothing to skip.
+
+        Every segment ending more than skip_until seconds before the end of
+        the playlist is swapped for one EXT-X-SKIP. Built once per output
+        version.
+        """
+        if self.ended or not self.skip_until or not self.body_segments:
+            return self._output
+        return self._view(SKIP, self._build_delta)
+
+    def _build_delta(self) -> bytes:
+        skipped = bisect_right(self.segment_elapsed, self._duration() - self.skip_until)
+        if skipped == 0:
+            return self._output
+
+        header_end = self._header_end()
+        lines = self._header_lines(header_end, version=SKIP_VERSION)
+        lines.append(SKIP + b":SKIPPED-SEGMENTS=%d" % skipped)
+        return self._without_first(skipped, header_end, lines)
+
+    def live_window(self, seconds:float) -> bytes:
+        """The last `seconds` of the output as a sliding-window LIVE playlist.
+
+        For players that only ever watch the live edge -- the playlist stays
+        the same size all game instead of growing. It has no PLAYLIST-TYPE,
+        and its MEDIA-SEQUENCE and DISCONTINUITY-SEQUENCE count the segments
+        and discontinuities that have slid out. The window always opens on a
+        segment with a PROGRAM-DATE-TIME of its own, so never mid-filler.
+        Once the game's over it's just the whole playlist.
+        """
+        if self.ended or not self.body_segments:
+            return self._output
+        return self._view((LIVE_WINDOW, seconds), lambda: self._build_live_window(seconds))
+
+    def _build_live_window(self, seconds:float) -> bytes:
+        body = self.body
+        dropped = bisect_right(self.segment_elapsed, self._duration() - seconds)
+        if dropped:
+            program_date_time = body.find(PROGRAM_DATE_TIME, self.segment_ends[dropped - 1])
+            if program_date_time != -1 and program_date_time < self.segment_ends[-1]:
+                dropped = bisect_left(self.segment_ends, program_date_time)
+
+        header_end = self._header_end()
+        if dropped == 0:
+            lines = self._header_lines(header_end, keep_segment_tags=True, live=True)
+            return b"".join((b"\n".join(lines), b"\n", body[header_end:], self.tail))
+
+        # the header's DISCONTINUITY-SEQUENCE tag doesn't match, it isn't followed by a newline
+        discontinuities = body.count(DISCONTINUITY + b"\n", 0, self.segment_ends[dropped - 1])
+        lines = self._header_lines(header_end,
+                                   live=True,
+                                   media_sequence=(self.media_sequence or 0) + dropped,
+                                   discontinuities=discontinuities)
+        return self._without_first(dropped, header_end, lines)
+
+    def _view(self, view, build) -> bytes:
+        # one copy of each view per output version
+        version = (len(self.body), self.tail, self.start_tag)
+        cached = self._views.get(view)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        self._index_segments()
+        out = build()
+        self._views[view] = (version, out)
+        return out
+
+    def _duration(self) -> float:
+        tail_duration = sum(float(match.group(1)) for match in OUTPUT_SEGMENT_PATTERN.finditer(self.tail))
+        return self.segment_elapsed[-1] + tail_duration
+
+    def _header_end(self) -> int:
+        # start of the line the first segment's EXTINF is on
+        return self.body.rfind(b"\n", 0, self.body.find(EXTINF)) + 1
+
+    def _header_lines(self, header_end:int, version:int=None, keep_segment_tags:bool=False,
+                      live:bool=False, media_sequence:int=None, discontinuities:int=0) -> list:
+        """The header of the output, for a view that drops segments off the front.
+
+        Without keep_segment_tags the first segment's own tags go, since that
+        segment doesn't follow them anymore. version is a minimum to raise
+        EXT-X-VERSION to, live drops the PLAYLIST-TYPE, and the sequence
+        numbers move on by what was dropped.
+        """
+        header = bytes(self.body[:header_end])
+        # upstream may not have one, only needed once there's something to count
+        add_discontinuity_sequence = discontinuities and DISCONTINUITY_SEQUENCE not in header
+
+        lines = []
+        for line in header.split(b"\n"):
+            if not line:
+                continue
+            if not keep_segment_tags and (line == DISCONTINUITY or line.startswith((PROGRAM_DATE_TIME, CUE_OUT, CUE_IN))):
+                continue
+            tag, _, value = line.partition(b":")
+            if tag == VERSION and version is not None and int(value or 0) < version:
+                line = VERSION + b":%d" % version
+            elif tag == PLAYLIST_TYPE and live:
+                continue
+            elif tag == MEDIA_SEQUENCE and media_sequence is not None:
+                line = MEDIA_SEQUENCE + b":%d" % media_sequence
+            elif tag == DISCONTINUITY_SEQUENCE:
+                line = DISCONTINUITY_SEQUENCE + b":%d" % (int(value or 0) + discontinuities)
+            lines.append(line)
+            if tag == SERVER_CONTROL and self.start_tag:
+                lines.append(self.start_tag)
+            if tag == MEDIA_SEQUENCE and add_discontinuity_sequence:
+                lines.append(DISCONTINUITY_SEQUENCE + b":%d" % discontinuities)
+        return lines
+
+    def _without_first(self, dropped:int, header_end:int, lines:list) -> bytes:
+        """lines, then the output after its first `dropped` segments.
+
+        The last EXT-X-KEY among the dropped segments is repeated, so the
+        rest can still be decrypted.
+        """
+        body = self.body
+        cut = self.segment_ends[dropped - 1]
+        key_line = body.rfind(KEY, header_end, cut)
+        if key_line != -1:
+            lines.append(bytes(body[key_line:body.find(b"\n", key_line)]))
+        return b"".join((b"\n".join(lines), body[cut:], self.tail))
+
+    def _with_start_tag(self, body, tail:bytes=b"") -> bytes:
+        """body and tail joined, with the start tag after the header's SERVER-CONTROL line."""
+        if self._start_tag_at is None and self.start_tag:
+            control = self.body.find(SERVER_CONTROL)
+            if control != -1 and self.body.find(b"\n", control) != -1:
+                self._start_tag_at = self.body.find(b"\n", control)
+        if not self.start_tag or self._start_tag_at is None:
+            return b"".join((body, tail))
+
+        at = self._start_tag_at
+        with memoryview(body) as view:
+            return b"".join((view[:at], b"\n", self.start_tag, view[at:], tail))
+
+    def _start_tag(self, media:bytes, timeline:SegmentTimeline) -> bytes:
+        """EXT-X-START for a live playlist: hold-back from the live edge, on game rather than ads.
+
+        If hold-back lands in an ad break the start moves to the end of the
+        break, or, when that's too close to the edge (or the break is still
+        going), to the last segment before it. The offset is counted from the
+        end of the output, so it's in the output's time, i.e. with filler in
+        place of the ads.
+        """
+        if (self.ended or timeline is None or not timeline.timed or not len(timeline)
+                or not self.target_duration or ENDLIST in media[-64:]):
+            return b""
+
+        # past the last out, the output's about to get its ENDLIST
+        edge = timeline.end()
+        if self._end is not None and edge > self._end:
+            return b""
+        hold_back = round(HOLD_BACK_TARGETS * self.target_duration * MICROS)
+        first = max(0, bisect_right(timeline.start, edge - hold_back) - 1)
+        start = timeline.start[first]
+
+        ad_break = self._break_at(start)
+        if ad_break is not None:
+            if ad_break.closed() and edge - ad_break.end >= MIN_START_TARGETS * self.target_duration * MICROS:
+                start = ad_break.end
             else:
-                rewritten.append(line)
-
-        elif cued_out:
-            continue
-
-        elif line.endswith(".ts") or line.endswith(".aac") or line.endswith(".vtt"):
-            rewritten.append(own_base + line)
-            segment_count += 1
-
-        elif not line.startswith('#'):
-            rewritten.append(own_base + line)
-            segment_count += 1
-            logger.warning("unknown segment: " + line)
-
-        elif "URI=" in line:
-            rewritten.append(uri_search_and_replace(line, own_base))
-
-        # elif line.startswith("#EXT-X-PLAYLIST-TYPE:"):
-        #     res = re.search(PLAYLIST_TYPE_PATTERN, line)
-        #     playlist_type = res.group(1)
-
-        #     if playlist_type == "EVENT":
-        #         rewritten.append("#EXT-X-PLAYLIST-TYPE:LIVE")
-        #     else:
-        #         rewritten.append(line)
-
-        #anything we just want to reprint
-        elif (line.startswith("#EXTM3U")
-              or line.startswith("#EXTINF:")
-              or line.startswith("#EXT-X-VERSION:")
-              or line.startswith("#EXT-X-TARGETDURATION:")
-              or line.startswith("#EXT-X-MEDIA-SEQUENCE:")
-              or line.startswith("#EXT-X-PROGRAM-DATE-TIME")
-              or line.startswith("#EXT-X-PLAYLIST-TYPE:")):
-            
-            rewritten.append(line)
-
-        #ad stuff
-        elif (line.startswith("#EXT-X-CUE-OUT-CONT:")
-              or line.startswith("#EXT-OATCLS-SCTE35")):
-                if ad_free:
-                    pass
-                else:
-                    rewritten.append(line)
-
-        else:
-            logger.warning(f"keeping unknown line: {line}")
-            rewritten.append(line)
-
-    elapsed_ms = (time.perf_counter() - func_start) * 1000
-    logger.info(f"rewrote vod playlist in {elapsed_ms:.2f}ms. {segment_count} segments, {extinf_count} EXTINF lines, {len(rewritten)} total lines")
-    return '\n'.join(rewritten)
-        
-async def rewrite_live_playlist2(stream:Stream, playlist:str, lines:list, own_base:str, ad_free=True, strip=True, start_time:datetime=None, end_time:datetime=None):
-    func_start = time.perf_counter()
-    rewritten = []
-    cued_out = False
-    stream_time = None
-    extinf_count = 0
-    segment_count = 0
-    started_segments = False
-    ad_elapsed = 0.0
-    expected_ad_duration = 0.0
-
-    resolution = await stream.get_variant_split_resolution(playlist)
-    frame_rate = await stream.get_variant_ntsc_frame_rate(playlist)
-    filler_duration = await stream.get_variant_filler_duration(playlist)
-
-    video_playlist = bool(resolution and frame_rate)
-
-    for line in lines:
-
-        if not line:
-            continue
-
-        elif line.startswith("#EXT-X-ENDLIST"):
-            rewritten.append(line)
-
-        elif line.startswith("#EXT-X-PROGRAM-DATE-TIME:"):
-            if strip:
-                ts = line.split(":", 1)[1]
-                stream_time = datetime.fromisoformat(ts.replace("Z", "+00:00"))
-
-            if (not cued_out
-                    and (not start_time or stream_time >= start_time)
-                    and (not end_time or stream_time <= end_time)):
-                rewritten.append(line)
-
-        elif line.startswith("#EXTINF:"):
-            segment_start_time = None
-
-            try:
-                duration = float(line[len("#EXTINF:"):].split(",")[0])
-            except ValueError as err:
-                logger.error(f"failed to parse EXTINF duration: {line}\n{err}")
-                raise
-
-            if strip:   
-                segment_start_time = stream_time
-                if stream_time is not None:
-                    stream_time = stream_time + timedelta(seconds=duration)
-
-            if cued_out:
-                ad_elapsed += duration
-
-            if (not cued_out
-                    and (not start_time or stream_time >= start_time)
-                    and (not end_time or stream_time <= end_time)):
-
-                if not started_segments and segment_start_time is not None:
-                    last_line = rewritten[-1] if rewritten else None
-                    if not (last_line and last_line.startswith("#EXT-X-PROGRAM-DATE-TIME:")):
-                        rewritten.append(format_program_date_time(segment_start_time))
-
-                rewritten.append(line)
-                extinf_count += 1
-                started_segments = True
-
-        elif start_time and stream_time and stream_time < start_time:
-            continue
-
-        elif end_time and stream_time and stream_time > end_time:
-            rewritten.append("#EXT-X-ENDLIST")
-            break
-
-        elif line.startswith("#EXT-X-CUE-IN"):
-
-            if ad_free:
-
-                if not cued_out:
-                    logger.warning("received unexpected #EXT-X-CUE-IN")
-
-                cued_out = False
-
-                logger.debug(f"received CUE-IN\nexpected ad duration: {expected_ad_duration}\nad elapsed: {ad_elapsed}")
-
-                if abs(ad_elapsed - expected_ad_duration) > 1:
-                    logger.warning(f"mismatch between expected ad duration ({expected_ad_duration}) and actual ad elapsed ({ad_elapsed})")
-
-                if ad_elapsed > 1:
-                    rewritten.extend(all_filler_no_killer(own_base,
-                                                          await stream.get_variant_split_resolution(playlist),
-                                                          await stream.get_variant_ntsc_frame_rate(playlist),
-                                                          ad_elapsed,
-                                                          await stream.get_variant_filler_duration(playlist)))
-
-                ad_elapsed = 0.0
-                expected_ad_duration = 0.0
-
+                before = bisect_left(timeline.start, ad_break.start - MATCH_TOLERANCE) - 1
+                if before < 0:
+                    return b""
+                start = timeline.start[before]
+
+        offset = max(0.0, self._output_seconds(start, edge) - START_SLACK)
+        return START + b":TIME-OFFSET=-%.3f" % offset
+
+    def _break_at(self, micros:int) -> AdBreak:
+        # the break micros falls inside, if any
+        if self.ad_breaks is None:
+            return None
+        i = bisect_right(self.ad_breaks.starts, micros + MATCH_TOLERANCE) - 1
+        if i < 0:
+            return None
+        ad_break = self.ad_breaks.breaks[i]
+        if ad_break.closed() and micros >= ad_break.end - MATCH_TOLERANCE:
+            return None
+        return ad_break
+
+    def _output_seconds(self, start:int, edge:int) -> float:
+        """How long the output runs from upstream time start to the edge, with breaks as they're rewritten."""
+        seconds = (edge - start) / MICROS
+        if self.ad_breaks is None or self.policy == PASSTHROUGH:
+            return seconds
+
+        ad_breaks = self.ad_breaks
+        for i in range(bisect_left(ad_breaks.starts, start - MATCH_TOLERANCE), len(ad_breaks)):
+            ad_break = ad_breaks.breaks[i]
+            if ad_break.closed():
+                ad_seconds = (ad_break.end - ad_break.start) / MICROS
+                seconds += self._break_seconds(ad_break.observed) - ad_seconds
             else:
-                rewritten.append(line)
-
-        elif line.startswith("#EXT-X-CUE-OUT:"):
-
-            if ad_free:
-
-                if cued_out:
-                    logger.warning("received unexpected #EXT-X-CUE-OUT")
-
-                cued_out = True
-
-                if video_playlist:
-                    ad_elapsed = 0.0
-                    try:
-                        expected_ad_duration = float(line.split(":", 1)[1])
-                    except ValueError as err:
-                        logger.error(f"failed to parse CUE-OUT duration: {line}\n{err}")
-                        expected_ad_duration = 0.0
-
+                # open at the edge, filler so far goes out as the tail
+                ad_seconds = (edge - ad_break.start) / MICROS
+                seconds += (self._break_seconds(ad_seconds) if ad_seconds > 1 else 0.0) - ad_seconds
+        return seconds
+
+    def _break_seconds(self, ad_elapsed:float) -> float:
+        # how long _break_output() makes a break of ad_elapsed seconds
+        if self.policy == FILLER and ad_elapsed > 1:
+            return filler_count(ad_elapsed, self.filler_duration) * self.filler_duration
+        return 0.0
+
+    def _cut(self, media:bytes, timeline:SegmentTimeline) -> list:
+        """(clock, start, stop, ad break) pieces of media that can matter given the game's start/end trim.
+
+        The header always goes through. Segments are bisected out of the
+        timeline: from the one playing at first pitch, through the first one
+        starting after the last out -- the tables still make the exact
+        per-line call at both edges, the cut just skips what's certainly out.
+        """
+        first = 0
+        if self._start is not None:
+            # the first segment still running at first pitch, i.e. the first
+            # one the tables could keep
+            first = max(0, bisect_left(timeline.start, self._start) - 1)
+            while first < len(timeline) - 1 and timeline.segment_end(first) < self._start:
+                first += 1
+            while first > 0 and timeline.segment_end(first - 1) >= self._start:
+                first -= 1
+
+        stop = len(media)
+        if self._end is not None:
+            # the first segment starting after the last out is where the
+            # tables end the playlist, nothing past it can make the output
+            after = bisect_right(timeline.start, self._end) + 1
+            if after < len(timeline):
+                stop = timeline.offset[after] - 1
+
+        if first == 0:
+            return [(None, 0, stop, None)]
+        if stop < timeline.offset[first]:
+            # end before start, nothing sensible to cut -- let the tables sort it out
+            return [(None, 0, len(media), None)]
+
+        # pick up the clock right where the skipped segments would have left it
+        return [(None, 0, timeline.offset[0] - 1, None),
+                (timeline.segment_end(first - 1), timeline.offset[first], stop, None)]
+
+    def _splice_breaks(self, media:bytes, timeline:SegmentTimeline, pieces:list) -> list:
+        """Split out every closed ad break the stream's map already measured.
+
+        A break runs from its CUE-OUT line through its CUE-IN line. Those
+        stretches come back as their own pieces so feed() can drop them whole
+        and splice in the break's filler without walking the ad segments.
+        """
+        spliced = []
+        for clock, start, stop, _ in pieces:
+            for ad_break in self.ad_breaks.breaks:
+                if not ad_break.closed():
+                    break
+                cut = self._break_range(media, timeline, ad_break, start, stop)
+                if cut is None:
+                    continue
+                spliced.append((clock, start, cut[0], None))
+                spliced.append((None, cut[0], cut[1], ad_break))
+                clock, start = None, cut[1]
+            spliced.append((clock, start, stop, None))
+        return spliced
+
+    def _break_range(self, media:bytes, timeline:SegmentTimeline, ad_break:AdBreak, start:int, stop:int):
+        """(from, to) byte offsets of ad_break's cue lines in this variant, if they're both within start:stop."""
+        first = bisect_left(timeline.start, ad_break.start - MATCH_TOLERANCE)
+        last = bisect_left(timeline.start, ad_break.end - MATCH_TOLERANCE)
+        if first >= len(timeline) or last >= len(timeline) or first >= last:
+            return None
+        if timeline.offset[first] < start or timeline.start[first] > ad_break.start + MATCH_TOLERANCE:
+            return None
+
+        cue_out = media.find(CUE_OUT + b":", timeline.offset[first], timeline.offset[first + 1])
+        block_end = timeline.offset[last + 1] if last + 1 < len(timeline) else timeline.scanned
+        cue_in = media.find(CUE_IN, timeline.offset[last], block_end)
+        if cue_out == -1 or cue_in == -1:
+            return None
+
+        cue_in_end = media.find(b"\n", cue_in)
+        if cue_in_end == -1 or cue_in_end > stop:
+            return None
+        return cue_out, cue_in_end
+
+    def _can_splice(self, ad_break:AdBreak) -> bool:
+        # only when the whole break is well inside the game, otherwise the
+        # tables have trimming to do in there
+        return (not self.cued_out
+                and not self.ended
+                and self.window == IN_GAME
+                and (self._start is None or ad_break.start >= self._start)
+                and (self._end is None or ad_break.end <= self._end))
+
+    def _splice(self, ad_break:AdBreak) -> list:
+        """Everything a CUE-OUT ... CUE-IN stretch would have rewritten to, straight from the map."""
+        self.stream_time = ad_break.end
+        self._tick()
+        out = self._break_output(ad_break.observed)
+        if out is None:
+            return []
+        return [out] if out.__class__ is bytes else out
+
+    # ENGINE
+    def rewrite(self, lines):
+        """Yield the rewritten form of each upstream line, in order."""
+        for line in lines:
+            if not line:
+                continue
+
+            out = self._table[line.partition(b":")[0] if line[0] == HASH else b""](line)
+
+            if out is None:
+                continue
+            if out.__class__ is bytes:
+                yield out
             else:
-                rewritten.append(line)
-
-        elif cued_out:
-            continue
-
-        elif line.endswith(".ts") or line.endswith(".aac") or line.endswith(".vtt"):
-            rewritten.append(own_base + line)
-            segment_count += 1
-
-        elif not line.startswith('#'):
-            rewritten.append(own_base + line)
-            segment_count += 1
-            logger.warning("unknown segment: " + line)
-
-        elif "URI=" in line:
-            rewritten.append(uri_search_and_replace(line, own_base))
-
-        # elif line.startswith("#EXT-X-PLAYLIST-TYPE:"):
-        #     res = re.search(PLAYLIST_TYPE_PATTERN, line)
-        #     playlist_type = res.group(1)
-
-        #     if playlist_type == "EVENT":
-        #         rewritten.append("#EXT-X-PLAYLIST-TYPE:LIVE")
-        #     else:
-        #         rewritten.append(line)
-
-        #anything we just want to reprint
-        elif (line.startswith("#EXTM3U")
-              or line.startswith("#EXTINF:")
-              or line.startswith("#EXT-X-VERSION:")
-              or line.startswith("#EXT-X-TARGETDURATION:")
-              or line.startswith("#EXT-X-MEDIA-SEQUENCE:")
-              or line.startswith("#EXT-X-PROGRAM-DATE-TIME")
-              or line.startswith("#EXT-X-PLAYLIST-TYPE:")):
-            
-            rewritten.append(line)
+                yield from out
+
+    def pending_filler(self) -> bytes:
+        if self.cued_out and self.policy == FILLER and self.ad_elapsed > 1:
+            return filler_block(self.own_base, self.resolution, self.frame_rate, self.ad_elapsed, self.filler_duration)
+        return b""
+
+    # HANDLERS
+    def _keep(self, line):
+        return line
+
+    def _drop(self, line):
+        return None
+
+    def _on_target_duration(self, line):
+        # blocking reloads, delta updates and hold-back are all about a
+        # playlist that's still growing
+        if not self.live:
+            return line
+
+        try:
+            target = float(line.partition(b":")[2])
+        except ValueError:
+            target = DEFAULT_TARGET_DURATION
+
+        control = []
+        if BLOCKING_RELOAD:
+            control.append(b"CAN-BLOCK-RELOAD=YES")
+        if DELTA_UPDATES:
+            self.skip_until = SKIP_UNTIL_TARGETS * target
+            control.append(b"CAN-SKIP-UNTIL=%.1f" % self.skip_until)
+        if START_OFFSET:
+            control.append(b"HOLD-BACK=%.1f" % (HOLD_BACK_TARGETS * target))
+
+        if control:
+            return [line, SERVER_CONTROL + b":" + b",".join(control)]
+        return line
+
+    def _on_program_date_time(self, line):
+        self.stream_time = parse_program_date_time(line[len(PROGRAM_DATE_TIME) + 1:])
+        self._tick()
+
+        if not self.cued_out and self.window == IN_GAME:
+            self.program_date_time_kept = True
+            return line
+
+    def _on_extinf(self, line):
+        try:
+            duration = float(line[len(EXTINF) + 1:].split(b",", 1)[0])
+        except ValueError as err:
+            logger.error(f"failed to parse EXTINF duration: {line.decode(errors='replace')}\n{err}")
+            raise
+
+        self.duration = duration
+        segment_start_time = self.stream_time
+        if segment_start_time is not None:
+            # rounded the same way timedelta(seconds=duration) would be
+            self.stream_time = segment_start_time + round(duration * MICROS)
+            self._tick()
+
+        if self.cued_out:
+            self.ad_elapsed += duration
+            return None
+
+        if self.window != IN_GAME:
+            return None
+
+        self.extinf_count += 1
+
+        if not self.started_segments:
+            self.started_segments = True
+            # the first segment we keep needs a timestamp of its own, even if
+            # the PROGRAM-DATE-TIME in front of it was trimmed
+            if segment_start_time is not None and not self.program_date_time_kept:
+                return [format_program_date_time(segment_start_time).encode(), line]
+
+        return line
+
+    def _on_segment(self, line):
+        if not line.endswith(SEGMENT_EXTENSIONS):
+            logger.warning(f"unknown segment: {line.decode(errors='replace')}")
+
+        self.segments.append(line.decode(), self.duration)
+        self.segment_count += 1
+        return self._own_base + line
+
+    def _on_other_tag(self, line):
+        if b"URI=" in line:
+            match = URI_BYTES_PATTERN.search(line)
+            return line[:match.start(1)] + self._own_base + line[match.start(1):]
+
+        logger.warning(f"keeping unknown line: {line.decode(errors='replace')}")
+        return line
+
+    def _on_cue_out(self, line):
+        if self.cued_out:
+            logger.warning("received unexpected #EXT-X-CUE-OUT")
+
+        self.cued_out = True
+        self.ad_start = self.stream_time
+        self.ad_elapsed = 0.0
+        try:
+            self.expected_ad_duration = float(line.partition(b":")[2] or 0)
+        except ValueError as err:
+            logger.error(f"failed to parse CUE-OUT duration: {line.decode(errors='replace')}\n{err}")
+            self.expected_ad_duration = 0.0
+
+        self._select_table()
+
+    def _on_cue_in(self, line):
+        if not self.cued_out:
+            logger.warning("received unexpected #EXT-X-CUE-IN")
+
+        self.cued_out = False
+        self._select_table()
+
+        ad_elapsed = self.ad_elapsed
+        ad_break = self._mapped_break()
+        if ad_break is not None:
+            # the map already measured this one, use its length so every
+            # variant gets the same filler
+            ad_elapsed = ad_break.observed
+        else:
+            logger.debug(f"received CUE-IN\nexpected ad duration: {self.expected_ad_duration}\nad elapsed: {ad_elapsed}")
+            if abs(ad_elapsed - self.expected_ad_duration) > 1:
+                logger.warning(f"mismatch between expected ad duration ({self.expected_ad_duration}) and actual ad elapsed ({ad_elapsed})")
 
-        #ad stuff
-        elif (line.startswith("#EXT-X-CUE-OUT-CONT:")
-              or line.startswith("#EXT-OATCLS-SCTE35")):
-                if ad_free:
-                    pass
-                else:
-                    rewritten.append(line)
+        self.ad_start = None
+        self.ad_elapsed = 0.0
+        self.expected_ad_duration = 0.0
 
-        else:
-            logger.warning(f"keeping unknown line: {line}")
-            rewritten.append(line)
+        return self._break_output(ad_elapsed)
 
-    if cued_out and ad_elapsed > 1:
-        rewritten.append(all_filler_no_killer(own_base,
-                                              await stream.get_variant_split_resolution(playlist),
-                                              await stream.get_variant_ntsc_frame_rate(playlist),
-                                              ad_elapsed,
-                                              await stream.get_variant_filler_duration(playlist)))
+    def _mapped_break(self) -> AdBreak:
+        if self.ad_breaks is None or self.ad_start is None:
+            return None
+        ad_break = self.ad_breaks.find(self.ad_start)
+        if ad_break is None or not ad_break.closed():
+            return None
+        return ad_break
 
-    elapsed_ms = (time.perf_counter() - func_start) * 1000
-    logger.info(f"rewrote vod playlist in {elapsed_ms:.2f}ms. {segment_count} segments, {extinf_count} EXTINF lines, {len(rewritten)} total lines")
-    return '\n'.join(rewritten)
+    def _break_output(self, ad_elapsed:float):
+        if self.policy == FILLER and ad_elapsed > 1:
+            return filler_block(self.own_base, self.resolution, self.frame_rate, ad_elapsed, self.filler_duration)
 
+        if ad_elapsed > 0:
+            return DISCONTINUITY # throw one of these bad boys in there
 
+    def _on_end(self, line):
+        # first line past the last out -- cap the playlist and ignore the rest
+        self.ended = True
+        self._select_table()
+        return ENDLIST
 
 def all_filler_no_killer(own_base,resolution, frame_rate, seconds, filler_duration):
     """Build a complete, self-contained filler ad break of the given duration.
 
-    Unlike rewrite_live_playlist2 (which swaps filler in for specific real ad
-    segments as they arrive), this generates a whole break from scratch --
-    for when there's no real upstream ad-break structure to match against,
-    just a target duration. Segment URIs are absolute, prefixed with
-    own_base, matching how the rewrite_* functions above serve segments
-    through this proxy rather than pointing directly at upstream.
+    This is what PlaylistRewriter puts in place of an ad break under the
+    filler policy (via filler_block()). The break is built from just its
+    length -- the ad break once it's over, or the provisional tail while
+    it's still going -- with none of the upstream ad segments' structure.
+    Segment URIs are prefixed with own_base, like every URI the rewriter
+    writes, so filler is served through this proxy.
+
+    The break is always a whole number of filler segments, so it only
+    depends on that count -- blocks are built once per (rendition, filler
+    duration, count, own_base) and handed back as a shared tuple after that.
     """
+    return _filler_entry(own_base, resolution, frame_rate, seconds, filler_duration)[0]
+
+def filler_block(own_base, resolution, frame_rate, seconds, filler_duration) -> bytes:
+    """all_filler_no_killer(), as the newline-joined bytes PlaylistRewriter splices in."""
+    return _filler_entry(own_base, resolution, frame_rate, seconds, filler_duration)[1]
+
+def filler_count(seconds, filler_duration) -> int:
+    # the original loop added filler_duration until it reached seconds, i.e.
+    # ceil() -- rounded first so float noise in seconds can't add a segment
+    return max(0, math.ceil(round(seconds / filler_duration, 6)))
+
+def _filler_entry(own_base, resolution, frame_rate, seconds, filler_duration) -> tuple:
+    count = filler_count(seconds, filler_duration)
+    key = (resolution, frame_rate, filler_duration, count, own_base)
+
+    entry = _FILLER_BLOCKS.get(key)
+    if entry is not None:
+        _FILLER_BLOCKS.move_to_end(key)
+        return entry
+
+    lines = _build_filler_block(own_base, resolution, frame_rate, count, filler_duration)
+    entry = (lines, "\n".join(lines).encode())
+    _FILLER_BLOCKS[key] = entry
+    if len(_FILLER_BLOCKS) > FILLER_BLOCK_CACHE_SIZE:
+        _FILLER_BLOCKS.popitem(last=False)
+    return entry
+
+def _build_filler_block(own_base, resolution, frame_rate, count, filler_duration) -> tuple:
     # gfs.rendition_dir() returns an OS filesystem path (backslashes on
     # Windows) -- URLs always need forward slashes, so re-derive the
     # relative "<resolution>/<framerate>" URL fragment from it rather than
@@ -541,26 +1243,24 @@ def all_filler_no_killer(own_base,resolution, frame_rate, seconds, filler_durati
     rel_dir = os.path.relpath(gfs.rendition_dir(resolution, frame_rate), gfs.OUTPUT_DIR).replace(os.sep, "/")
 
     lines = []
-    lines.append(f"#EXT-X-CUE-OUT:{seconds:.3f}")
+    lines.append(f"#EXT-X-CUE-OUT:{count * filler_duration:.3f}")
     lines.append("#EXT-X-DISCONTINUITY")
 
     # count down from the full break duration to 0, one filler segment at a
     # time, so the countdown baked into each frame lines up with how much of
     # the break is actually left
-    elapsed = 0.0
-    while elapsed < seconds:
-        seconds_remaining = seconds - elapsed
+    extinf = f"#EXTINF:{filler_duration:.6f},"
+    for i in range(count):
+        seconds_remaining = (count - i) * filler_duration
         idx = max(0, min(gfs.MAX_SECONDS, round(seconds_remaining)))
 
-        lines.append(f"#EXTINF:{filler_duration:.6f},")
+        lines.append(extinf)
         lines.append(f"{own_base}filler/{rel_dir}/filler_{idx:03d}.ts")
 
-        elapsed += filler_duration
-
     # leaving the filler segments' fabricated timeline -- CUE-IN forwarding
     # is intentional (see earlier discussion), paired with the discontinuity
     # back to whatever real timeline resumes after this
     lines.append("#EXT-X-CUE-IN")
     lines.append("#EXT-X-DISCONTINUITY")
 
-    return lines
+    return tuple(lines)
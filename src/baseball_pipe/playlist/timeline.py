@@ -0,0 +1,164 @@
+import re
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timezone
+
+# clocks here are integer microseconds since the epoch -- the same resolution
+# datetime has, without allocating one per playlist line
+MICROS = 1_000_000
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+PROGRAM_DATE_TIME_TAG = b"#EXT-X-PROGRAM-DATE-TIME:"
+MEDIA_SEQUENCE_PATTERN = re.compile(rb'#EXT-X-MEDIA-SEQUENCE:(\d+)')
+# one segment: EXTINF, any tags after it, then its URI line -- a segment
+# isn't indexed until upstream has written the whole thing
+SEGMENT_PATTERN = re.compile(rb'#EXTINF:([^,\n]*)[^\n]*\n(?:#[^\n]*\n|\n)*[^#\n][^\n]*\n')
+
+# trailing upstream text remembered to confirm a refreshed playlist still
+# starts with what was already processed
+FINGERPRINT_LENGTH = 256
+
+DOT, COLON, ZULU = b".:Z"
+
+_MINUTE_MICROS = {} # b"YYYY-MM-DDTHH:MM" -> epoch microseconds, see parse_program_date_time
+
+def to_micros(dt:datetime) -> int:
+    if dt is None:
+        return None
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * MICROS + delta.microseconds
+
+def _minute_micros(minute:bytes) -> int:
+    micros = to_micros(datetime.fromisoformat(minute.decode() + ":00+00:00"))
+    if len(_MINUTE_MICROS) >= 4096:
+        _MINUTE_MICROS.clear()
+    _MINUTE_MICROS[minute] = micros
+    return micros
+
+def parse_program_date_time(ts:bytes) -> int:
+    """Parse an HLS PROGRAM-DATE-TIME value into microseconds since the epoch.
+
+    Upstream always writes UTC as YYYY-MM-DDTHH:MM:SS.fffZ, and a whole game
+    only spans a couple hundred distinct minutes -- so the minute is looked
+    up once and cached, and only the seconds get parsed per line. Anything
+    shaped differently goes through datetime.fromisoformat.
+    """
+    if len(ts) == 24 and ts[19] == DOT and ts[23] == ZULU and ts[16] == COLON:
+        base = _MINUTE_MICROS.get(ts[:16])
+        if base is None:
+            base = _minute_micros(ts[:16])
+        return base + int(ts[17:19] + ts[20:23]) * 1000
+
+    return to_micros(datetime.fromisoformat(ts.decode().replace("Z", "+00:00")))
+
+def media_sequence(media:bytes) -> int:
+    match = MEDIA_SEQUENCE_PATTERN.search(media, 0, 1024)
+    return int(match.group(1)) if match else 0
+
+class SegmentTimeline():
+    """Where every segment of one upstream media playlist sits in time and in the text.
+
+    Parallel arrays, one entry per segment: media sequence number, start
+    (epoch microseconds), duration (seconds) and the byte offset in the
+    upstream playlist where the segment's block of lines (PROGRAM-DATE-TIME, cues, EXTINF,
+    URI) begins. Built by matching whole segments rather than walking every
+    line, and extended in place while upstream only appends.
+
+    Start times are non-decreasing, so a wall-clock time maps to a segment
+    by bisection -- used to cut a playlist at first pitch / last out and to
+    seek without scanning.
+    """
+
+    def __init__(self):
+        self.sequence = array("q")
+        self.start = array("q")
+        self.duration = array("d")
+        self.offset = array("q")
+
+        # False once a segment turns up with no PROGRAM-DATE-TIME to place it by
+        self.timed = True
+
+        self.media_sequence = None
+        self.scanned = 0
+        self.fingerprint = b""
+        self._clock = None
+
+    def __len__(self):
+        return len(self.start)
+
+    def nbytes(self) -> int:
+        return sum(a.itemsize * len(a) for a in (self.sequence, self.start, self.duration, self.offset))
+
+    def continues(self, media:bytes) -> bool:
+        if self.media_sequence is None:
+            return True
+        return (len(media) >= self.scanned
+                and media.startswith(self.fingerprint, self.scanned - len(self.fingerprint))
+                and media_sequence(media) == self.media_sequence)
+
+    def update(self, media:bytes):
+        """Index any segments upstream appended since the last update."""
+        if self.media_sequence is None:
+            self.media_sequence = media_sequence(media)
+
+        if len(media) == self.scanned:
+            return
+
+        clock = self._clock
+        block = self.scanned
+        starts, durations, offsets = [], [], []
+        find, rfind = media.find, media.rfind
+        pdt_length = len(PROGRAM_DATE_TIME_TAG)
+
+        for match in SEGMENT_PATTERN.finditer(media, self.scanned):
+            extinf = match.start()
+            program_date_time = rfind(PROGRAM_DATE_TIME_TAG, block, extinf)
+            if program_date_time != -1:
+                start = program_date_time + pdt_length
+                clock = parse_program_date_time(media[start:find(b"\n", start)].rstrip())
+
+            if not offsets and not len(self):
+                # the first block starts at its own PROGRAM-DATE-TIME/EXTINF,
+                # everything above that is header
+                block = extinf if program_date_time == -1 else program_date_time
+
+            if clock is None:
+                self.timed = False
+                clock = 0
+
+            duration = float(match.group(1))
+            starts.append(clock)
+            durations.append(duration)
+            offsets.append(block)
+
+            # rounded the same way timedelta(seconds=duration) would be
+            clock += round(duration * MICROS)
+            block = match.end()
+
+        first_sequence = self.media_sequence + len(self)
+        self.sequence.extend(range(first_sequence, first_sequence + len(starts)))
+        self.start.extend(starts)
+        self.duration.extend(durations)
+        self.offset.extend(offsets)
+
+        self._clock = clock
+        self.scanned = block
+        self.fingerprint = media[max(0, self.scanned - FINGERPRINT_LENGTH):self.scanned]
+
+    def locate(self, micros:int) -> int:
+        """Index of the segment playing at the given epoch microseconds, or -1 if it's before the first one."""
+        return bisect_right(self.start, micros) - 1
+
+    def sequence_at(self, micros:int) -> int:
+        index = max(0, self.locate(micros))
+        return self.sequence[index] if len(self) else None
+
+    def segment_end(self, index:int) -> int:
+        """Epoch microseconds where the segment at index ends."""
+        return self.start[index] + round(self.duration[index] * MICROS)
+
+    def end(self) -> int:
+        """Epoch microseconds where the last indexed segment ends."""
+        if not len(self):
+            return None
+        return self.segment_end(-1)
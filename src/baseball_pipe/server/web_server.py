@@ -64,13 +64,16 @@ class WebServer:
         self.auth_session = AsyncSession()
 
         self.mlbtv_account = baseball_pipe.mlbtv.account2.Account(self.master_session, self.auth_session, proxy=self.proxy_url)
-        await self.mlbtv_account._gen_token()
+        await self.mlbtv_account.start()
 
         app["master_session"] = self.master_session
         app["mlbtv_account"] = self.mlbtv_account
         app["proxy_url"] = self.proxy_url
 
     async def on_cleanup(self, app):
+        logger.info(f"segment cache stats: {self.mlbtv_account.segment_cache.stats()}")
+        logger.info(f"account stats: {self.mlbtv_account.stats()}")
+        await self.mlbtv_account.close()
         if self.master_session:
             await self.master_session.close()
         if self.auth_session:
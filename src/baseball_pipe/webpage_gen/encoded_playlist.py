@@ -0,0 +1,135 @@
+import asyncio
+import gzip
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError: # in requirements.txt, but gzip still works without it
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+GZIP = "gzip"
+BROTLI = "br"
+
+# each coding is different bytes, so gets its own strong validator
+ETAG_SUFFIXES = {GZIP: "-gz", BROTLI: "-br"}
+
+# players poll playlists every few seconds, so compress well but not slowly
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# not worth a Content-Encoding header below this
+MIN_COMPRESS_BYTES = 1024
+
+# one entry per variant per stream being watched
+ENCODED_PLAYLIST_CACHE_SIZE = int(os.environ.get("bbp_encoded_playlist_cache", 256))
+
+def _compress(encoding:str, body:bytes) -> bytes:
+    if encoding == BROTLI:
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+def accepted_encodings(accept_encoding:str) -> set:
+    """Content codings the client will take, going by its Accept-Encoding header."""
+    accepted = set()
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q=") and params[2:] in ("0", "0.0", "0.00", "0.000"):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+def _opaque_tag(etag:str) -> str:
+    etag = etag.strip()
+    return etag[2:] if etag.startswith("W/") else etag
+
+def etag_matches(if_none_match:str, etag:str) -> bool:
+    """If-None-Match uses the weak comparison -- W/"x" matches "x" (a proxy like nginx weakens ours when it gzips)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    etag = _opaque_tag(etag)
+    return any(_opaque_tag(tag) == etag for tag in if_none_match.split(","))
+
+class EncodedPlaylist():
+    """One version of a rewritten playlist, with its ETag and compressed copies.
+
+    The ETag is a hash of the plain bytes, so it only changes when the
+    content does -- with a suffix per content coding, since a strong
+    validator has to differ between gzip, br and identity. Each compressed
+    copy is made (in a worker thread, a VOD playlist can be a few hundred
+    KB) the first time a client asks for that coding, and reused by every
+    request after that.
+    """
+
+    def __init__(self, body:bytes, source=None):
+        self.body = body
+        self.source = source # what body was made from, for callers that cache by it
+        self._hash = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.etag = f'"{self._hash}"'
+        self._encoded = {} # coding -> bytes, or a Future while it's being compressed
+
+    def etag_for(self, encoding:str) -> str:
+        """The ETag of the body as sent with encoding (None for identity)."""
+        if encoding is None:
+            return self.etag
+        return f'"{self._hash}{ETAG_SUFFIXES[encoding]}"'
+
+    def preferred_encoding(self, accept_encoding:str) -> str:
+        if len(self.body) < MIN_COMPRESS_BYTES or not accept_encoding:
+            return None
+        accepted = accepted_encodings(accept_encoding)
+        if brotli is not None and BROTLI in accepted:
+            return BROTLI
+        if GZIP in accepted:
+            return GZIP
+        return None
+
+    async def encoded(self, encoding:str) -> bytes:
+        encoded = self._encoded.get(encoding)
+        if isinstance(encoded, bytes):
+            return encoded
+        if encoded is None:
+            loop = asyncio.get_running_loop()
+            encoded = loop.run_in_executor(None, _compress, encoding, self.body)
+            self._encoded[encoding] = encoded
+
+        try:
+            data = await asyncio.shield(encoded)
+        except Exception:
+            self._encoded.pop(encoding, None)
+            raise
+
+        if self._encoded.get(encoding) is encoded:
+            self._encoded[encoding] = data
+            logger.debug(f"{encoding} playlist: {len(self.body)} -> {len(data)} bytes")
+        return data
+
+class EncodedPlaylistCache():
+    """The latest EncodedPlaylist per key, so a version is hashed and compressed only once."""
+
+    def __init__(self, max_entries:int=ENCODED_PLAYLIST_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, key, made_from) -> EncodedPlaylist:
+        """The cached version for key, if it's the one made from made_from (its body or its source)."""
+        entry = self._entries.get(key)
+        if entry is None or (entry.body is not made_from and entry.source is not made_from):
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def store(self, key, body:bytes, source=None) -> EncodedPlaylist:
+        entry = EncodedPlaylist(body, source)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
@@ -3,9 +3,11 @@ import os
 from aiohttp import web
 
 from baseball_pipe.mlbtv.stream import Stream
+from baseball_pipe.mlbtv.media_playlist import Playlist
 from baseball_pipe.misc.header_handler import cors_headers
-from baseball_pipe.playlist.stream_mangler import prefix_master_urls, rewrite_media_playlist
+from baseball_pipe.playlist.stream_mangler import prefix_master_urls, rewrite_media_playlist, rewrite_media_playlist_at, BLOCKING_RELOAD, DELTA_UPDATES, LIVE_WINDOW, LIVE_WINDOW_MINUTES
 from baseball_pipe.playlist import generate_filler_segments as gfs
+from baseball_pipe.webpage_gen.encoded_playlist import EncodedPlaylist, EncodedPlaylistCache, etag_matches
 
 logger = logging.getLogger(__name__)
 
@@ -16,32 +18,203 @@ SEGMENT_CONTENT_TYPES = {
     ".vtt": "text/vtt",
 }
 
-async def serve_master_playlist(request: web.Request, stream: Stream):
-    gamePK = request.match_info.get("gamePK")
-    mediaId = request.match_info.get("mediaId")
+# pipe uncached segments through to the player as upstream sends them,
+# instead of buffering the whole segment before the first byte goes out
+RELAY_SEGMENTS = os.environ.get("bbp_relay_segments", "1") != "0"
 
-    playlist = await stream.get_master_playlist()
+# write playlist URIs as /gamePK/mediaId/... instead of baking in the origin
+# the player asked through (LAN IP, nginx hostname, ...) -- the rewrite is
+# then the same for every viewer, so one copy per variant serves them all
+RELATIVE_URIS = os.environ.get("bbp_relative_uris", "1") != "0"
 
-    own_base = f"{request.url.origin()}/{gamePK}/{mediaId}/"
-    playlist = prefix_master_urls(playlist, own_base)
+# send a media playlist that has to be rewritten from scratch (a finished
+# game's first request) as chunks while it's being rewritten
+STREAM_PLAYLISTS = os.environ.get("bbp_stream_playlists", "1") != "0"
 
-    return web.Response(text=playlist, headers=cors_headers("application/vnd.apple.mpegurl"))
+# gzip/brotli playlists for players that take them, compressed once per
+# playlist version rather than once per request
+COMPRESS_PLAYLISTS = os.environ.get("bbp_compress_playlists", "1") != "0"
 
-async def serve_media_playlist(request: web.Request, stream: Stream, path: str):
+PLAYLIST_CONTENT_TYPE = "application/vnd.apple.mpegurl"
+
+# latest version of each (stream, variant, own base) playlist sent out
+_encoded_playlists = EncodedPlaylistCache()
+
+# live window length a player can ask for, in minutes
+LIVE_WINDOW_RANGE = (1, 60)
+
+def get_own_base(request: web.Request) -> str:
     gamePK = request.match_info.get("gamePK")
     mediaId = request.match_info.get("mediaId")
 
-    own_base = f"{request.url.origin()}/{gamePK}/{mediaId}/"
-    playlist = await rewrite_media_playlist(stream, path, own_base)
+    if RELATIVE_URIS:
+        return f"/{gamePK}/{mediaId}/"
+    return f"{request.url.origin()}/{gamePK}/{mediaId}/"
+
+def viewer_id(request: web.Request) -> tuple:
+    """Tells players apart well enough to count them -- two on the same box and app count once."""
+    return (request.remote, request.headers.get("User-Agent", ""))
+
+def seen(request: web.Request, stream: Stream, playlist: Playlist = None):
+    if stream.viewers is None:
+        return
+    if playlist is None:
+        stream.viewers.touch(str(stream), viewer_id(request))
+    else:
+        stream.viewers.touch(str(stream), viewer_id(request), playlist.name, playlist.rendition_group())
+
+async def playlist_response(request: web.Request, encoded: EncodedPlaylist):
+    encoding = encoded.preferred_encoding(request.headers.get("Accept-Encoding")) if COMPRESS_PLAYLISTS else None
+
+    headers = cors_headers(PLAYLIST_CONTENT_TYPE)
+    headers["ETag"] = encoded.etag_for(encoding)
+    headers["Vary"] = "Accept-Encoding"
+
+    # player already has this version, in this coding
+    if etag_matches(request.headers.get("If-None-Match"), headers["ETag"]):
+        del headers["Content-Type"]
+        return web.Response(status=304, headers=headers)
+
+    if encoding is None:
+        return web.Response(body=encoded.body, headers=headers)
+
+    headers["Content-Encoding"] = encoding
+    return web.Response(body=await encoded.encoded(encoding), headers=headers)
+
+def live_window_minutes(request: web.Request) -> int:
+    """How many minutes of live edge this player wants, or None for the whole game.
+
+    Opted into with ?live_window=N on the master or media playlist, or a
+    live_window=N cookie -- TV boxes that can't take a query string on
+    their saved URL can use the cookie. An N that isn't a number gets the
+    default length.
+    """
+    value = request.query.get(LIVE_WINDOW, request.cookies.get(LIVE_WINDOW))
+    if value is None or value == "0":
+        return None
+    try:
+        minutes = int(value)
+    except ValueError:
+        minutes = int(LIVE_WINDOW_MINUTES)
+    return min(max(minutes, LIVE_WINDOW_RANGE[0]), LIVE_WINDOW_RANGE[1])
 
-    return web.Response(text=playlist, headers=cors_headers("application/vnd.apple.mpegurl"))
+async def serve_master_playlist(request: web.Request, stream: Stream):
+    seen(request, stream)
+    master = await stream.get_master_playlist()
+    own_base = get_own_base(request)
+
+    # a window asked for in the query has to ride along on the media
+    # playlist URIs, the player won't carry it over by itself
+    window = live_window_minutes(request) if LIVE_WINDOW in request.query else None
+    query = f"{LIVE_WINDOW}={window}" if window else None
+
+    # the stream hands back the same text until its cached copy expires,
+    # so only prefix (and hash) a new one
+    key = (str(stream), None, own_base, window)
+    encoded = _encoded_playlists.get(key, master)
+    if encoded is None:
+        encoded = _encoded_playlists.store(key, prefix_master_urls(master, own_base, query).encode(), source=master)
+
+    return await playlist_response(request, encoded)
+
+def blocking_reload_msn(request: web.Request) -> int:
+    """The media sequence number a blocking playlist reload is waiting for, if this is one."""
+    msn = request.query.get("_HLS_msn")
+    part = request.query.get("_HLS_part")
+    if msn is None:
+        if part is not None:
+            raise web.HTTPBadRequest(text="_HLS_part without _HLS_msn")
+        return None
+
+    try:
+        msn = int(msn)
+        # no partial segments upstream, so a part of msn is ready once all of msn is
+        if part is not None:
+            int(part)
+    except ValueError:
+        raise web.HTTPBadRequest(text="_HLS_msn and _HLS_part must be integers")
+    if msn < 0:
+        raise web.HTTPBadRequest(text="_HLS_msn must not be negative")
+    return msn
+
+async def follow_variant(stream: Stream, path: str):
+    # someone's watching, keep following upstream for them in the background
+    if stream.poller is not None:
+        stream.poller.watch(stream, await stream.get_variant(path))
+
+async def serve_media_playlist(request: web.Request, stream: Stream, path: str):
+    variant = await stream.get_variant(path)
+    if variant is not None:
+        seen(request, stream, variant)
+    own_base = get_own_base(request)
+
+    # YES skips segments, v2 would also skip date ranges -- there are none
+    skip = DELTA_UPDATES and request.query.get("_HLS_skip") in ("YES", "v2")
+
+    minutes = live_window_minutes(request)
+    window = minutes * 60 if minutes else None
+
+    msn = blocking_reload_msn(request) if BLOCKING_RELOAD else None
+    if msn is not None:
+        try:
+            playlist = await rewrite_media_playlist_at(stream, path, own_base, msn, skip=skip, window=window)
+        except ValueError as err:
+            raise web.HTTPBadRequest(text=str(err))
+        if playlist is None:
+            raise web.HTTPServiceUnavailable(text=f"media sequence {msn} not available yet")
+    else:
+        playlist = await rewrite_media_playlist(stream, path, own_base, chunked=STREAM_PLAYLISTS, skip=skip, window=window)
+
+    # already rewritten, straight from the rewriter's copy
+    if isinstance(playlist, bytes):
+        await follow_variant(stream, path)
+        key = (str(stream), path, own_base, window or skip)
+        encoded = _encoded_playlists.get(key, playlist) or _encoded_playlists.store(key, playlist)
+        return await playlist_response(request, encoded)
+
+    # rewriting from scratch -- send each piece as it's done. there's no
+    # ETag until it's all written, the next poll picks one up
+    try:
+        response = web.StreamResponse(headers=cors_headers(PLAYLIST_CONTENT_TYPE))
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        async for chunk in playlist:
+            await response.write(chunk)
+    finally:
+        playlist.close()
+
+    await follow_variant(stream, path)
+    await response.write_eof()
+    return response
 
 async def serve_segment(request: web.Request, stream: Stream, path: str):
     ext = os.path.splitext(path)[1].lower()
     content_type = SEGMENT_CONTENT_TYPES.get(ext, "application/octet-stream")
 
-    data = await stream.get_segment(path)
-    return web.Response(body=data, headers=cors_headers(content_type))
+    # a player that loaded a VOD playlist once only comes back for segments
+    if stream.viewers is not None:
+        seen(request, stream, stream.segment_variant(path))
+    if stream.prefetcher:
+        stream.prefetcher.on_segment(stream, path)
+
+    # cache hits, and segments another player is already pulling, are
+    # served whole -- only a fresh upstream fetch is worth relaying
+    if not RELAY_SEGMENTS or stream.segment_cached(path) or stream.segment_in_flight(path):
+        data = await stream.get_segment(path)
+        return web.Response(body=data, headers=cors_headers(content_type))
+
+    response = web.StreamResponse(headers=cors_headers(content_type))
+    async with stream.relay_segment(path) as relay:
+        content_length = await relay.start()
+        if content_length is not None:
+            response.content_length = content_length
+
+        await response.prepare(request)
+        async for chunk in relay.chunks():
+            await response.write(chunk)
+
+    await response.write_eof()
+    return response
 
 async def serve_filler_segment(request: web.Request, path: str):
     # path is "filler/<resolution>/<framerate>/filler_NNN.ts" -- strip the
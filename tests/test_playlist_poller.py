@@ -0,0 +1,61 @@
+import asyncio
+
+from baseball_pipe.mlbtv.stream import Stream
+from baseball_pipe.mlbtv.media_playlist import Playlist
+from baseball_pipe.playlist.playlist_poller import PlaylistPoller
+from baseball_pipe.webpage_gen import media_handler
+
+def make_stream(poller:PlaylistPoller) -> Stream:
+    stream = Stream(None, "1", "m", None, None, poller=poller)
+    stream._variants = {"aac.m3u8": Playlist(stream, "aac.m3u8", {"type": "AUDIO", "group-id": "aac"})}
+    return stream
+
+def test_empty_poller_starts_following_a_variant():
+    async def main():
+        poller = PlaylistPoller()
+        stream = make_stream(poller)
+
+        await media_handler.follow_variant(stream, "aac.m3u8")
+        assert len(poller) == 1
+
+        await poller.close()
+
+    asyncio.run(main())
+
+LIVE = b"#EXTM3U\n#EXT-X-TARGETDURATION:6\n#EXT-X-MEDIA-SEQUENCE:0\n#EXTINF:6.0,\nseg_0.ts\n"
+
+def polled_playlist(age:float, fetches:list) -> Playlist:
+    playlist = make_stream(None)._variants["aac.m3u8"]
+    playlist._media_cache.store(LIVE)
+    playlist._media_cache.fetched_at -= age
+    playlist._media_cache.expires_at -= age
+    playlist.polled = True
+
+    async def gen_media():
+        fetches.append(age)
+        raise Exception("upstream down")
+    playlist._gen_media = gen_media
+    return playlist
+
+def test_polled_copy_is_served_while_recent():
+    async def main():
+        fetches = []
+        playlist = polled_playlist(10, fetches)
+        assert await playlist.get_media() == LIVE
+        assert not fetches
+
+    asyncio.run(main())
+
+def test_stale_polled_copy_goes_back_upstream():
+    async def main():
+        fetches = []
+        playlist = polled_playlist(60, fetches)
+        # upstream's still down, so it's the old copy -- but we did look
+        assert await playlist.get_media() == LIVE
+        assert len(fetches) == 1
+
+        # and back off before looking again
+        await playlist.get_media()
+        assert len(fetches) == 1
+
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from aiohttp.test_utils import make_mocked_request
+
+import baseball_pipe.mlbtv.session_renewer as session_renewer
+from baseball_pipe.mlbtv.stream import Stream
+from baseball_pipe.mlbtv.segment_cache import SegmentCache, normalize_key
+from baseball_pipe.mlbtv.viewer_registry import ViewerRegistry
+from baseball_pipe.webpage_gen import media_handler
+
+def expires_in(seconds:float) -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=seconds)).isoformat().replace("+00:00", "Z")
+
+def make_stream(viewers:ViewerRegistry, sessions:list) -> Stream:
+    stream = Stream(None, "1", "m", None, None, segment_cache=SegmentCache(), viewers=viewers)
+    stream._set_playback("http://upstream/1/master.m3u8", expires_in(2))
+    stream.segment_cache.put(normalize_key(str(stream), "1080p/seg_00000.ts"), b"x" * 188)
+
+    async def init_playback_session():
+        sessions.append(stream._expiration)
+        return (f"http://upstream/{len(sessions) + 1}/master.m3u8", expires_in(60))
+    async def gen_master_playlist():
+        return "#EXTM3U\n"
+    stream._init_playback_session = init_playback_session
+    stream._gen_master_playlist = gen_master_playlist
+    return stream
+
+def test_watched_stream_is_renewed_before_it_expires(monkeypatch):
+    monkeypatch.setattr(session_renewer, "MIN_RENEW_WAIT", 0.01)
+
+    async def main():
+        viewers = ViewerRegistry()
+        renewer = session_renewer.SessionRenewer(viewers, lead=1.5)
+        sessions = []
+        stream = make_stream(viewers, sessions)
+        expiration = Stream._parse_expiration(stream._expiration)
+
+        request = make_mocked_request("GET", "/1/m/1080p/seg_00000.ts", headers={"User-Agent": "player"})
+        await media_handler.serve_segment(request, stream, "1080p/seg_00000.ts")
+        renewer.watch(stream)
+
+        await asyncio.sleep(1.5)
+        assert renewer.renewals == 1
+        assert datetime.now(timezone.utc) < expiration
+        assert stream._upstream_base_url == "http://upstream/2/"
+        assert stream.seconds_until_expired() > 30
+
+        await renewer.close()
+        await viewers.close()
+
+    asyncio.run(main())
+
+def test_unwatched_stream_is_left_to_lapse(monkeypatch):
+    monkeypatch.setattr(session_renewer, "MIN_RENEW_WAIT", 0.01)
+
+    async def main():
+        viewers = ViewerRegistry()
+        renewer = session_renewer.SessionRenewer(viewers, lead=1.5)
+        sessions = []
+        stream = make_stream(viewers, sessions)
+        renewer.watch(stream)
+
+        await asyncio.sleep(1.5)
+        assert renewer.renewals == 0 and not sessions
+        assert len(renewer) == 0
+
+        await renewer.close()
+        await viewers.close()
+
+    asyncio.run(main())
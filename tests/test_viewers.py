@@ -0,0 +1,44 @@
+import asyncio
+
+from aiohttp.test_utils import make_mocked_request
+
+from baseball_pipe.mlbtv.stream import Stream
+from baseball_pipe.mlbtv.segment_cache import SegmentCache, normalize_key
+from baseball_pipe.mlbtv.viewer_registry import ViewerRegistry
+from baseball_pipe.webpage_gen import media_handler
+
+def make_stream(viewers:ViewerRegistry) -> Stream:
+    stream = Stream(None, "1", "m", None, None, segment_cache=SegmentCache(), viewers=viewers)
+    stream.segment_cache.put(normalize_key(str(stream), "1080p/seg_00000.ts"), b"x" * 188)
+    return stream
+
+def request():
+    return make_mocked_request("GET", "/1/m/1080p/seg_00000.ts", headers={"User-Agent": "player"})
+
+def test_empty_registry_still_counts_the_first_viewer():
+    async def main():
+        viewers = ViewerRegistry()
+        joined = []
+        viewers.subscribe(on_join=joined.append)
+
+        stream = make_stream(viewers)
+        response = await media_handler.serve_segment(request(), stream, "1080p/seg_00000.ts")
+        assert response.status == 200
+
+        assert viewers.count(str(stream)) == 1
+        assert len(joined) == 1
+        await viewers.close()
+
+    asyncio.run(main())
+
+def test_same_player_counts_once():
+    async def main():
+        viewers = ViewerRegistry()
+        stream = make_stream(viewers)
+        for _ in range(3):
+            await media_handler.serve_segment(request(), stream, "1080p/seg_00000.ts")
+
+        assert viewers.counts() == {str(stream): {"viewers": 1, "variants": {}}}
+        await viewers.close()
+
+    asyncio.run(main())